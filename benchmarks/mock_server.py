@@ -0,0 +1,177 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BASE_UTS = 1600000000  # timestamp of the newest synthetic scrobble
+
+
+class SyntheticLibrary:
+    '''
+    Deterministic synthetic listening history, scrobbles are generated on demand so large libraries need no memory
+    '''
+
+    def __init__(self, scrobbles=1000, tracks=None, artists=None, unmapped=0.05, seed=0):
+        '''
+        :param scrobbles: number of scrobbles in the history
+        :param tracks: number of distinct tracks, defaults to a fifth of the scrobbles
+        :param artists: number of distinct artists, defaults to a tenth of the tracks
+        :param unmapped: fraction of tracks spotify search finds no match for
+        :param seed: seed for the track sequence
+        '''
+        self.scrobbles = scrobbles
+        self.tracks = tracks or max(1, scrobbles // 5)
+        self.artists = artists or max(1, self.tracks // 10)
+        self.unmapped = unmapped
+        self.seed = seed
+
+    def track_of(self, index):
+        # cheap deterministic shuffle of the track played at position index
+        return (index * 2654435761 + self.seed) % self.tracks
+
+    def artist_of(self, track):
+        return track % self.artists
+
+    def scrobble(self, index):
+        track = self.track_of(index)
+        artist = self.artist_of(track)
+        return {'artist': {'#text': 'Artist {}'.format(artist), 'mbid': ''},
+                'album': {'#text': 'Album {}'.format(track // 12), 'mbid': ''},
+                'name': 'Track {} (Remastered)'.format(track), 'mbid': '',
+                'date': {'uts': str(BASE_UTS - index * 180)}}
+
+    def is_mapped(self, track):
+        return random.Random(track + self.seed).random() >= self.unmapped
+
+
+class MockServer:
+    '''
+    Local stand-in for the last.fm user.getrecenttracks endpoint and the spotify search, artists and
+    audio-features endpoints, with configurable latency and 429 injection
+    '''
+
+    def __init__(self, library, latency=0.0, throttle=0.0, retry_after=1, port=0):
+        '''
+        :param library: SyntheticLibrary served by the mock
+        :param latency: seconds every response is delayed by
+        :param throttle: fraction of spotify requests answered with 429 Too Many Requests
+        :param retry_after: Retry-After header value of injected 429 responses
+        :param port: port to listen on, 0 picks a free port
+        '''
+        self.library = library
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(library.seed)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def throttled(self):
+        with self.lock:
+            return self.random.random() < self.throttle
+
+    def recent_tracks(self, query):
+        library = self.library
+        limit = int(query.get('limit', ['50'])[0])
+        page = int(query.get('page', ['1'])[0])
+        total = library.scrobbles
+        if 'from' in query:
+            total = min(total, max(0, (BASE_UTS - int(query['from'][0]) - 1) // 180 + 1))
+        start = (page - 1) * limit
+        tracks = [library.scrobble(index) for index in range(start, min(start + limit, total))]
+        return {'recenttracks': {'track': tracks, '@attr': {'page': str(page), 'perPage': str(limit),
+                                                            'totalPages': str(-(-total // limit)),
+                                                            'total': str(total)}}}
+
+    def search(self, query):
+        text = query.get('q', [''])[0]
+        items = []
+        try:
+            track = int(text.split('track:')[1].split()[1])
+        except (IndexError, ValueError):
+            track = None
+        if track is not None and self.library.is_mapped(track):
+            artist = self.library.artist_of(track)
+            items.append({'id': 'track{}'.format(track), 'duration_ms': 180000 + track % 60000,
+                          'popularity': track % 100, 'name': 'Track {}'.format(track),
+                          'artists': [{'id': 'artist{}'.format(artist), 'name': 'Artist {}'.format(artist)}]})
+        return {'tracks': {'items': items, 'total': len(items)}}
+
+    def artists(self, query):
+        ids = query.get('ids', [''])[0].split(',')
+        return {'artists': [{'id': artist_id, 'genres': ['genre {}'.format(int(artist_id[6:]) % 40)]}
+                            for artist_id in ids if artist_id]}
+
+    def audio_features(self, query):
+        ids = query.get('ids', [''])[0].split(',')
+        features = []
+        for track_id in ids:
+            rng = random.Random(track_id)
+            features.append({'id': track_id, 'danceability': rng.random(), 'energy': rng.random(),
+                             'key': rng.randrange(12), 'loudness': -rng.random() * 20, 'mode': rng.randrange(2),
+                             'speechiness': rng.random(), 'acousticness': rng.random(),
+                             'instrumentalness': rng.random(), 'liveness': rng.random(), 'valence': rng.random(),
+                             'tempo': 60 + rng.random() * 120})
+        return {'audio_features': features}
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, status, body, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                path = parsed.path.rstrip('/')
+                if server.latency:
+                    time.sleep(server.latency)
+                if path.endswith('/2.0'):
+                    server.count('lastfm.recenttracks')
+                    return self.respond(200, server.recent_tracks(query))
+                routes = {'/search': server.search, '/artists': server.artists,
+                          '/audio-features': server.audio_features}
+                for suffix, route in routes.items():
+                    if path.endswith(suffix):
+                        endpoint = 'spotify.' + suffix.strip('/')
+                        server.count(endpoint)
+                        if server.throttled():
+                            server.count(endpoint + '.429')
+                            return self.respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                                {'Retry-After': str(server.retry_after)})
+                        return self.respond(200, route(query))
+                self.respond(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+        return Handler
@@ -0,0 +1,141 @@
+'''
+Offline throughput benchmark for lfmxtractplus.
+
+Runs get_scrobbles, map_to_spotify, map_audio_features and generate_dataset end to end against a local mock of
+the last.fm and spotify apis and reports wall time, throughput, peak memory and api call counts of each stage.
+Every stage runs on a fresh client, so generate_dataset is a cold end to end run.
+With --throttle the run fails if the injected 429 responses didn't reach the shared spotify scheduler.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --latency 0.02 --throttle 0.01
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lfmxtractplus import export_data  # noqa: E402
+from lfmxtractplus.export_data import lfmxtractplus  # noqa: E402
+from lfmxtractplus.ratelimit import RequestScheduler, TokenBucket  # noqa: E402
+from mock_server import MockServer, SyntheticLibrary  # noqa: E402
+
+
+class BenchmarkClient(lfmxtractplus):
+    '''
+    lfmxtractplus pointed at the mock server, authenticating with a static token instead of OAuth
+    '''
+
+    def authenticate(self):
+        self.token_info = {'access_token': 'benchmark'}  # no expires_at, never refreshed
+        self.sp_oauth = None
+        self.sp = self.create_spotify('benchmark')
+
+
+def make_client(server, workdir):
+    cfg_path = os.path.join(workdir, 'config.yaml')
+    with open(cfg_path, 'w') as stream:
+        yaml.safe_dump({'sp_cid': 'benchmark', 'sp_secret': 'benchmark', 'lf_key': 'benchmark',
+                        'log_path': os.path.join(workdir, 'output.log'), 'data_path': os.path.join(workdir, 'data'),
+                        'cache_path': None, 'lf_api_url': server.url + '2.0/', 'sp_api_url': server.url + 'v1/'},
+                       stream)
+    return BenchmarkClient(cfg_path)
+
+
+def measure(name, func):
+    '''
+    Run func while tracking wall time and peak traced memory
+    :return (result, dict with seconds and peak_mb)
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'stage': name, 'seconds': seconds, 'peak_mb': peak / 2 ** 20}
+
+
+def run(size, args):
+    library = SyntheticLibrary(scrobbles=size, unmapped=args.unmapped)
+    server = MockServer(library, latency=args.latency, throttle=args.throttle, retry_after=args.retry_after).start()
+    # every client of the run uses the 'benchmark' credentials and so shares these
+    export_data.lastfm_limiters['benchmark'] = TokenBucket(rate=args.lastfm_rate)
+    scheduler = export_data.spotify_schedulers['benchmark'] = RequestScheduler(transient=(requests.RequestException,))
+    results = []
+
+    def stage(name, func, rows):
+        '''
+        Time func on a fresh client, so no stage is helped by matches and genres cached by an earlier one
+        :return result of func
+        '''
+        lf = make_client(server, workdir)
+        before = dict(server.calls)
+        result, stats = measure(name, lambda: func(lf))
+        calls = {endpoint: count - before.get(endpoint, 0) for endpoint, count in dict(server.calls).items()
+                 if count != before.get(endpoint, 0)}
+        results.append(dict(stats, rows=rows(result), server_calls=calls, client_stats=lf.get_stats()))
+        return result
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            scrobbles = stage('get_scrobbles', lambda lf: lf.get_scrobbles('benchmark'), len)
+
+            uniques = scrobbles.groupby(['artist_name', 'track_name']).size().rename('frequency').reset_index()
+            mapped = stage('map_to_spotify', lambda lf: lf.map_to_spotify(uniques, workers=args.workers), len)
+            stage('map_audio_features', lambda lf: lf.map_audio_features(mapped), len)
+            stage('generate_dataset', lambda lf: lf.generate_dataset('benchmark'),
+                  lambda dataset: len(dataset['complete']))
+    finally:
+        server.stop()
+
+    for result in results:
+        result['size'] = size
+        result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+    return {'size': size, 'stages': results, 'server_calls': dict(server.calls),
+            'scheduler': {'retries': scheduler.retries, 'throttled': scheduler.throttled}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline lfmxtractplus benchmark against a local mock api server')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='scrobbles per synthetic library')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every mock response')
+    parser.add_argument('--throttle', type=float, default=0.0, help='fraction of spotify requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of injected 429s')
+    parser.add_argument('--unmapped', type=float, default=0.05, help='fraction of tracks search finds no match for')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent spotify searches')
+    parser.add_argument('--lastfm-rate', type=float, default=1000.0, help='last.fm requests per second allowed')
+    parser.add_argument('--json', help='write the full report to this file')
+    args = parser.parse_args(argv)
+
+    reports = [run(size, args) for size in args.sizes]
+
+    print('\n{:>9} {:<20} {:>9} {:>10} {:>12} {:>10}   {}'.format('size', 'stage', 'rows', 'seconds', 'rows/s',
+                                                                       'peak MB', 'api calls'))
+    for report in reports:
+        for stage in report['stages']:
+            print('{:>9} {:<20} {:>9} {:>10.2f} {:>12.0f} {:>10.1f}   {}'.format(
+                stage['size'], stage['stage'], stage['rows'], stage['seconds'], stage['rows_per_second'],
+                stage['peak_mb'], ', '.join('{}={}'.format(endpoint, count)
+                                            for endpoint, count in sorted(stage['server_calls'].items()))))
+        print('{:>9} spotify scheduler: retries={retries}, throttled={throttled}'.format(report['size'],
+                                                                                  **report['scheduler']))
+
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(reports, stream, indent=2)
+
+    for report in reports:
+        injected = sum(count for endpoint, count in report['server_calls'].items() if endpoint.endswith('.429'))
+        if injected and not report['scheduler']['throttled']:
+            sys.exit('{} 429 responses bypassed the spotify scheduler'.format(injected))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,20 @@
+import importlib
+
 VERSION = '1.2'
-from .export_data import lfmxtractplus
\ No newline at end of file
+
+# submodules are only imported when one of their names is first used, so importing the package stays cheap
+_exports = {'lfmxtractplus': 'export_data', 'LastfmError': 'export_data', 'SpotifyAuthError': 'export_data',
+            'AsyncLfmxtractplus': 'async_client'}
+__all__ = ['VERSION'] + list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
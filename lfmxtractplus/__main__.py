@@ -0,0 +1,41 @@
+import argparse
+import os
+
+import pandas as pd
+
+from .export_data import lfmxtractplus
+
+
+def main(argv=None):
+    '''
+    Command line entry point, generates datasets for one or more last.fm users
+    :param argv: command line arguments (defaults to sys.argv)
+    '''
+    parser = argparse.ArgumentParser(prog='lfmxtractplus',
+                                     description='Extract last.fm scrobbles enriched with spotify audio features')
+    parser.add_argument('config', help='path to config.yaml')
+    parser.add_argument('usernames', nargs='+', help='last.fm usernames')
+    parser.add_argument('--timezone', default='Asia/Kolkata', help="timezone of the users' scrobbles")
+    parser.add_argument('--pages', type=int, default=0, help='pages to retrieve per user, 0 for full histories')
+    parser.add_argument('--workers', type=int, default=4, help='number of users fetched concurrently')
+    parser.add_argument('--out', default='.', help='output directory')
+    parser.add_argument('--format', choices=['pickle', 'parquet'], default='pickle', help='output format')
+    args = parser.parse_args(argv)
+
+    lf = lfmxtractplus(args.config)
+    datasets = lf.generate_datasets(args.usernames, timezone=args.timezone, pages=args.pages, workers=args.workers)
+
+    os.makedirs(args.out, exist_ok=True)
+    for username, scrobblesDFdict in datasets.items():
+        if scrobblesDFdict is None:
+            print("\nNo dataset for " + username)
+            continue
+        if args.format == 'parquet':
+            lf.export_dataset(scrobblesDFdict, os.path.join(args.out, username))
+        else:
+            pd.to_pickle(scrobblesDFdict, os.path.join(args.out, username + '.pkl'))
+        print("\nSaved dataset for " + username)
+
+
+if __name__ == '__main__':
+    main()
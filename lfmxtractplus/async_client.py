@@ -0,0 +1,426 @@
+import asyncio
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+
+from .export_data import (lfmxtractplus, LastfmError, chunked, json_loads, shared_limiter, token_expired,
+                          AUDIO_FEATURES, LASTFM_QUERY, LASTFM_RETRY_CODES, MISSING, PLAYLIST_FIELDS)
+from .ratelimit import AsyncRateLimiter
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency, only needed for AsyncLfmxtractplus
+    aiohttp = None
+
+# shared by every AsyncLfmxtractplus using the same credentials so interleaved extractions stay under the api limits
+lastfm_async_limiters = {}  # lf_key -> AsyncRateLimiter
+spotify_async_limiters = {}  # sp_cid -> AsyncRateLimiter
+
+
+class AsyncLfmxtractplus:
+    '''
+    asyncio variant of lfmxtractplus with awaitable get_scrobbles, map_to_spotify, map_audio_features,
+    get_playlist and generate_dataset, backed by a pooled aiohttp session (requires aiohttp).
+    Config, Spotify authentication, caches and metrics are shared with a synchronous lfmxtractplus object.
+
+        async with AsyncLfmxtractplus('config.yaml') as lf:
+            scrobbles = await lf.get_scrobbles('madhan_001')
+    '''
+
+    def __init__(self, cfgPath=None, client=None, concurrency=16, lastfm_limiter=None, spotify_limiter=None):
+        '''
+        :param cfgPath: filepath for config.yaml, not needed when client is passed
+        :param client: an initialized lfmxtractplus object to share config, authentication and caches with
+        :param concurrency: maximum number of concurrent requests (and pooled keep-alive connections)
+        :param lastfm_limiter: AsyncRateLimiter for last.fm requests, defaults to one shared by objects with the same lf_key
+        :param spotify_limiter: AsyncRateLimiter for spotify requests, defaults to one shared by objects with the same
+                                sp_cid
+        '''
+        if aiohttp is None:
+            raise ImportError("AsyncLfmxtractplus requires aiohttp, install it with pip install lfmxtractplus[async]")
+        self.client = client if client is not None else lfmxtractplus(cfgPath)
+        self.concurrency = concurrency
+        self.lastfm_limiter = lastfm_limiter or shared_limiter(
+            lastfm_async_limiters, self.client.lfkey, lambda: AsyncRateLimiter(rate=5))  # ~5 requests per second
+        self.spotify_limiter = spotify_limiter or shared_limiter(
+            spotify_async_limiters, self.client.cid, AsyncRateLimiter)  # no fixed rate, paused on 429 responses
+        self.metrics = self.client.metrics
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        '''
+        Create the pooled http session, called automatically by the first request
+        '''
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+    async def close(self):
+        '''
+        Close the http session
+        '''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def map_bounded(self, func, items):
+        '''
+        Awaits func for every item with at most `concurrency` calls in flight
+        :param func: coroutine function taking one item
+        :param items: list of items
+        :return list of results in the order of items
+        '''
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+
+        async def worker():
+            for index, item in pending:
+                results[index] = await func(item)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(self.concurrency, len(items))))))
+        return results
+
+    async def run_blocking(self, func, *args):
+        '''
+        Run a blocking call (sqlite cache, matching index) in a worker thread so it doesn't stall the event loop
+        :param func: function to call
+        :param args: positional arguments for func
+        :return return value of func
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    async def refresh_token(self, stale_token=None):
+        '''
+        Authenticate the wrapped client on first use and refresh its token in a worker thread if it is about to expire
+        :param stale_token: access token rejected by spotify, forces a refresh
+        :return True if the token was refreshed
+        '''
+        client = self.client
+        loop = asyncio.get_running_loop()
+        if client.sp is None:
+            await loop.run_in_executor(None, client.ensure_authenticated)
+        if client.spAuth == 'client_credentials':
+            return False  # the credentials manager renews app tokens itself
+        if stale_token is None and not token_expired(client.token_info):
+            return False
+        return await loop.run_in_executor(None, client.token_refresh, stale_token)
+
+    async def request(self, endpoint, url, params=None, spotify=False, retries=5):
+        '''
+        GET a json api response, retrying 429s (honouring Retry-After), 5xx responses and network errors
+        :param endpoint: endpoint name used for metrics
+        :param url: request url
+        :param params: query parameters
+        :param spotify: authenticate with the Spotify token and use the Spotify limiter
+        :param retries: number of retries before giving up
+        :return parsed json response, None for a non-retryable Spotify error
+        '''
+        await self.open()
+        limiter = self.spotify_limiter if spotify else self.lastfm_limiter
+        for attempt in range(retries + 1):
+            if attempt:
+                self.metrics.record_retry(endpoint)
+            delay = min(2 ** attempt, 60)
+            await limiter.acquire()
+            headers = None
+            if spotify:
+                await self.refresh_token()
+                token = await self.run_blocking(self.client.access_token)
+                headers = {'Authorization': 'Bearer ' + token}
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url, params=params, headers=headers) as response:
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+                    data = json_loads(await response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.metrics.record_call(endpoint, time.perf_counter() - start, e)
+                self.client.logger.warning("%s request failed : %s", endpoint, type(e).__name__)
+                await asyncio.sleep(delay)
+                continue
+
+            api_error = data.get('error') if isinstance(data, dict) and not spotify else None
+            failed = status >= 400 or api_error is not None
+            self.metrics.record_call(endpoint, time.perf_counter() - start, status if failed else None,
+                                     throttled=status == 429 or api_error == 29)
+            if status == 429:
+                try:
+                    pause = float(retry_after) if retry_after else delay
+                except ValueError:  # HTTP-date instead of seconds
+                    pause = delay
+                limiter.pause(pause)  # back off every coroutine
+                continue
+            if status == 401 and spotify and await self.refresh_token(stale_token=token):
+                continue
+            if status >= 500 or api_error in LASTFM_RETRY_CODES:
+                await asyncio.sleep(delay)
+                continue
+            if spotify and status >= 400:
+                self.client.logger.critical("SpotifyException %s on %s", status, endpoint)
+                return None
+            return data
+        self.client.logger.critical("Giving up on %s", endpoint)
+        if spotify:
+            return None
+        raise LastfmError("Failed to retrieve " + endpoint + " after " + str(retries) + " retries")
+
+    async def get_lastfm_page(self, username, page, method='recenttracks', limit=200, retries=3, from_uts=None):
+        '''
+        Retrieves a single page from the last.fm api
+        :param username: last.fm username for retrieval
+        :param page: page number to retrieve
+        :param method: api method
+        :param limit: number of records per page
+        :param retries: number of retries before giving up on the page
+        :param from_uts: only retrieve scrobbles after this unix timestamp
+        :return parsed json response
+        '''
+        request_url = self.client.lfUrl + LASTFM_QUERY.format(method, username, self.client.lfkey, limit, page)
+        if from_uts is not None:
+            request_url += '&from=' + str(int(from_uts))
+        return await self.request('lastfm.' + method, request_url, retries=retries)
+
+    async def get_scrobbles(self, username, method='recenttracks', timezone='Asia/Kolkata', limit=200, page=1,
+                            pages=0, retries=3, from_uts=None):
+        '''
+        Retrieves scrobbles from lastfm for a user, pages are fetched concurrently
+        :param method: api method
+        :param username: last.fm username for retrieval
+        :param timezone: timezone of the user (must correspond with the timezone in user's settings)
+        :param limit: api lets you retrieve up to 200 records per call
+        :param page: page of results to start retrieving at
+        :param pages: how many pages of results to retrieve. if 0, get as many as api can return.
+        :param retries: number of retries for each page before giving up
+        :param from_uts: only retrieve scrobbles after this unix timestamp
+
+        :return dataframe with lastfm scrobbles, None if last.fm returned an error
+        '''
+        with self.metrics.stage('get_scrobbles') as stage:
+            response = await self.get_lastfm_page(username, page, method, limit, retries, from_uts)
+            if 'error' in response:
+                self.client.logger.critical("Error code : %s", response['error'])
+                self.client.logger.critical("Error message : %s", response['message'])
+                return None
+
+            total_pages = int(response[method]['@attr']['totalPages'])
+            last_page = total_pages if pages <= 0 else min(total_pages, page + pages - 1)
+
+            async def fetch(page_no):
+                data = await self.get_lastfm_page(username, page_no, method, limit, retries, from_uts)
+                self.client.check_lastfm_error(data, page_no)
+                return self.client.scrobbles_to_frame(self.client.parse_scrobbles(data, method), timezone)
+
+            frames = [self.client.scrobbles_to_frame(self.client.parse_scrobbles(response, method), timezone)]
+            try:
+                frames.extend(await self.map_bounded(fetch, list(range(page + 1, last_page + 1))))
+            except LastfmError as e:
+                if e.code is None:  # a page failed after retries, not an api error for the request itself
+                    raise
+                return None
+            scrobblesDF = pd.concat(frames, ignore_index=True)
+            stage['rows'] = len(scrobblesDF)
+            return scrobblesDF
+
+    async def search_track(self, query):
+        '''
+        Search spotify for a track, consulting the persistent cache first
+        :param query: spotify search query
+        :return dict with trackID, lengthMS, popularity and artistID, None if the track couldn't be mapped
+        '''
+        cache = await self.run_blocking(getattr, self.client, 'cache')  # opened on first use
+        if cache is not None:
+            cached = await self.run_blocking(cache.get_search, query)
+            if cached is not None:
+                return cached if cached['trackID'] is not None else None
+
+        searchDict = await self.request('spotify.search', self.client.spUrl + 'search',
+                                        {'q': query, 'type': 'track', 'limit': 1, 'market': 'US'}, spotify=True)
+        if searchDict is None:
+            return None  # failed call, don't cache it as unmapped
+        result = None
+        if len(searchDict['tracks']['items']) != 0:
+            item = searchDict['tracks']['items'][0]
+            result = {'trackID': item['id'], 'lengthMS': item['duration_ms'], 'popularity': item['popularity'],
+                      'artistID': item['artists'][0]['id']}
+        if cache is not None:
+            await self.run_blocking(cache.put_search, query, result)
+        return result
+
+    async def get_artist_genres(self, artist_ids, batch_size=50):
+        '''
+        Get the first genre of each artist, resolving artists missing from the caches in bulk (up to 50 per call)
+        :param artist_ids: list of spotify artist IDs (may contain duplicates)
+        :param batch_size: number of artistIDs sent per api call (max 50)
+        :return dict of artistID -> genre name, None for artists without genres
+        '''
+        memory, cache = self.client.artist_genres, await self.run_blocking(getattr, self.client, 'cache')
+        genres = {}
+        missing = []
+        for artist_id in dict.fromkeys(artist_ids):
+            genre = memory.get(artist_id, MISSING)
+            if genre is MISSING:
+                missing.append(artist_id)
+            else:
+                genres[artist_id] = genre
+        if cache is not None and missing:
+            cached = await self.run_blocking(cache.get_artists, missing)
+            genres.update(cached)
+            missing = [artist_id for artist_id in missing if artist_id not in cached]
+
+        async def fetch(batch):
+            return await self.request('spotify.artists', self.client.spUrl + 'artists', {'ids': ','.join(batch)},
+                                      spotify=True)
+
+        for result in await self.map_bounded(fetch, list(chunked(missing, min(batch_size, 50)))):
+            if result is None:
+                continue
+            fetched = {artist['id']: artist['genres'][0] if artist['genres'] else None
+                       for artist in result['artists'] if artist}
+            if cache is not None:
+                await self.run_blocking(cache.put_artists, fetched)
+            genres.update(fetched)
+
+        for artist_id, genre in genres.items():
+            memory.put(artist_id, genre)
+        return genres
+
+    async def map_to_spotify(self, scrobblesDF):
+        '''
+        Maps track names to spotifyID and adds track length,popularity,genre to dataframe.
+        Tracks are looked up in the local matching index first, only tracks it can't match are searched for.
+        :param scrobblesDF : lastfm scrobbles dataframe
+        :return scrobblesDF : dataframe with spotifyID ,track length,popularity,genre
+        '''
+        with self.metrics.stage('map_to_spotify', rows=len(scrobblesDF)):
+            artists = self.client.clean_series(scrobblesDF['artist_name'].fillna(''), **self.client.queryOptions)
+            tracks = self.client.clean_series(scrobblesDF['track_name'].fillna(''), **self.client.queryOptions)
+            queries = ('artist:' + artists + ' track:' + tracks).tolist()
+            keys = self.client.track_keys(scrobblesDF)
+            match_index = await self.run_blocking(getattr, self.client, 'match_index')  # loaded on first use
+            matches = await self.run_blocking(lambda: [match_index.match(*key) for key in keys])
+
+            async def resolve(item):
+                query, match = item
+                return match if match is not None else await self.search_track(query)
+
+            results = await self.map_bounded(resolve, list(zip(queries, matches)))
+            await self.run_blocking(match_index.add, [key + (result,) for key, match, result
+                                                      in zip(keys, matches, results) if match is None])
+            resultsDF = pd.DataFrame([result or {} for result in results],
+                                     columns=['trackID', 'lengthMS', 'popularity', 'artistID'], index=scrobblesDF.index)
+            scrobblesDF['trackID'] = resultsDF['trackID']
+            scrobblesDF['lengthMS'] = resultsDF['lengthMS']
+            scrobblesDF['popularity'] = resultsDF['popularity']
+            genres = await self.get_artist_genres(resultsDF['artistID'].dropna().tolist())
+            scrobblesDF['genre_name'] = resultsDF['artistID'].map(genres)
+            return scrobblesDF
+
+    async def map_audio_features(self, scrobblesDF, batch_size=100):
+        '''
+        Adds track features to dataframe with SpotifyID, unique trackIDs are fetched in batches of up to 100
+        :param scrobblesDF: dataframe with SpotifyID
+        :param batch_size: number of trackIDs sent per api call (max 100)
+        :return enriched dataframe with audio features
+        '''
+        with self.metrics.stage('map_audio_features', rows=len(scrobblesDF)):
+            cache = await self.run_blocking(getattr, self.client, 'cache')
+            track_ids = scrobblesDF['trackID'].dropna().astype(str).unique().tolist()
+            features = []
+            if cache is not None:
+                cached = await self.run_blocking(cache.get_features, track_ids)
+                features = [[search_id] + [feature[name] for name in AUDIO_FEATURES]
+                            for search_id, feature in cached.items() if feature is not None]
+                track_ids = [search_id for search_id in track_ids if search_id not in cached]
+
+            async def fetch(batch):
+                return batch, await self.request('spotify.audio_features', self.client.spUrl + 'audio-features',
+                                                 {'ids': ','.join(batch)}, spotify=True)
+
+            for batch, result in await self.map_bounded(fetch, list(chunked(track_ids, min(batch_size, 100)))):
+                if result is None:
+                    continue
+                fetched = {}
+                for search_id, feature in zip(batch, result['audio_features']):
+                    fetched[search_id] = {name: feature.get(name) for name in AUDIO_FEATURES} if feature else None
+                    if feature:
+                        features.append([search_id] + [feature.get(name, np.nan) for name in AUDIO_FEATURES])
+                if cache is not None:
+                    await self.run_blocking(cache.put_features, fetched)
+
+            featuresDF = pd.DataFrame(features, columns=['trackID'] + AUDIO_FEATURES).set_index('trackID')
+            featuresDF = featuresDF.astype(dict.fromkeys(AUDIO_FEATURES, 'float64'))  # object when nothing was fetched
+            scrobblesDF = scrobblesDF.drop(columns=AUDIO_FEATURES, errors='ignore')
+            return scrobblesDF.join(featuresDF, on='trackID')
+
+    async def get_playlist(self, user='billboard.com', playlist_id='6UeSakyzhiEt4NB3UAd6NQ', limit=100):
+        '''
+        retrives audio features of a playlist (Billboard Hot 100 is the default playlist)
+        :param user: username of the playlist owner (kept for compatibility, playlists are looked up by id)
+        :param playlist_id: playlist id (found at the end of a playlist url)
+        :param limit: tracks per page (max 100)
+        :return: a dataframe with audio features of a playlist, the number of pages that couldn't be retrieved is
+                 stored in its attrs['failed_pages']
+        '''
+        with self.metrics.stage('get_playlist') as stage:
+            url = self.client.spUrl + 'playlists/' + playlist_id + '/tracks'
+
+            async def fetch(offset):
+                return await self.request('spotify.playlist_tracks', url,
+                                          {'fields': PLAYLIST_FIELDS, 'limit': limit, 'offset': offset}, spotify=True)
+
+            first = await fetch(0)
+            pages = [first]
+            if first is not None:
+                pages.extend(await self.map_bounded(fetch, list(range(limit, first['total'], limit))))
+            failed_pages = pages.count(None)
+            if failed_pages:
+                print("\nIncomplete playlist " + playlist_id + " (failed pages) : " + str(failed_pages))
+                self.client.logger.critical("Incomplete playlist %s (failed pages) : %s", playlist_id, failed_pages)
+
+            items = []
+            for page in pages:
+                for item in (page or {}).get('items', []):
+                    track = item.get('track')
+                    if not track or not track.get('id'):  # removed tracks and local files have no spotifyID
+                        continue
+                    items.append((track['name'], track['id'], track['artists'][0]['name'],
+                                  track['artists'][0]['id'], track['duration_ms'], track['popularity']))
+            playlistDF = pd.DataFrame(items, columns=['track', 'trackID', 'artist', 'artistID', 'lengthMS',
+                                                      'popularity'])
+            stage['rows'] = len(playlistDF)
+            genres = await self.get_artist_genres(playlistDF['artistID'].tolist())
+            playlistDF['genre'] = playlistDF['artistID'].map(genres)
+            playlistDF = playlistDF[['track', 'trackID', 'artist', 'artistID', 'genre', 'lengthMS', 'popularity']]
+        playlistDF = await self.map_audio_features(playlistDF)
+        playlistDF.attrs['failed_pages'] = failed_pages
+        return playlistDF
+
+    async def generate_dataset(self, lfusername, timezone='Asia/Kolkata', pages=0):
+        '''
+        Gets user's listening history and enriches it with Spotify audio features
+        :param lfusername: last.fm username
+        :param timezone: timezone of the user (must correspond with the timezone in user's settings)
+        :param pages: number of pages to retrieve, use pages = 0 to retrieve full listening history
+        :return scrobblesDFdict: dictionary with two dataframes ('complete' with timestamps and 'library' with
+                                 library contents)
+        '''
+        scrobblesDF_lastfm = await self.get_scrobbles(username=lfusername, timezone=timezone, pages=pages)
+        if scrobblesDF_lastfm is None:
+            return None
+
+        scrobblesDF_uniques = scrobblesDF_lastfm.groupby(['artist_name', 'track_name']).size()
+        scrobblesDF_uniques = scrobblesDF_uniques.rename('frequency').reset_index()
+        scrobblesDF_wFeatures_uniques = await self.map_audio_features(await self.map_to_spotify(scrobblesDF_uniques))
+
+        scrobblesDF_complete = pd.merge(scrobblesDF_lastfm, scrobblesDF_wFeatures_uniques, how='left',
+                                        on=['track_name', 'artist_name'])
+        return {'complete': scrobblesDF_complete, 'library': scrobblesDF_wFeatures_uniques}
@@ -0,0 +1,183 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DAY = 24 * 60 * 60
+
+
+class SpotifyCache:
+    '''
+    Persistent SQLite cache for spotify search results, artist genres and audio features.
+    Unmapped tracks and missing features are cached as negative entries so they aren't searched for on every run.
+    '''
+
+    def __init__(self, path, popularity_ttl=7 * DAY, negative_ttl=30 * DAY, artist_ttl=30 * DAY):
+        '''
+        :param path: filepath of the sqlite database
+        :param popularity_ttl: seconds before a search result (and its popularity) is fetched again
+        :param negative_ttl: seconds before an unmapped track or missing feature is looked up again
+        :param artist_ttl: seconds before an artist's genre is fetched again
+        '''
+        self.path = path
+        self.popularity_ttl = popularity_ttl
+        self.negative_ttl = negative_ttl
+        self.artist_ttl = artist_ttl
+        self.stats = {name: {'hits': 0, 'misses': 0} for name in ('search', 'artist', 'features')}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS search (query TEXT PRIMARY KEY, track_id TEXT, '
+                              'length_ms INTEGER, popularity INTEGER, artist_id TEXT, fetched_at REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS artist (artist_id TEXT PRIMARY KEY, genre TEXT, '
+                              'fetched_at REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS features (track_id TEXT PRIMARY KEY, features TEXT, '
+                              'fetched_at REAL)')
+
+    def _count(self, table, hit):
+        self.stats[table]['hits' if hit else 'misses'] += 1
+
+    def get_search(self, query):
+        '''
+        Look up a cached search result
+        :param query: cleaned spotify search query
+        :return dict with trackID, lengthMS, popularity and artistID (trackID is None for unmapped tracks),
+                None on a cache miss
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT track_id, length_ms, popularity, artist_id, fetched_at FROM search '
+                                    'WHERE query = ?', (query,)).fetchone()
+            ttl = self.popularity_ttl if row is not None and row[0] is not None else self.negative_ttl
+            hit = row is not None and time.time() - row[4] < ttl
+            self._count('search', hit)
+        if not hit:
+            return None
+        return {'trackID': row[0], 'lengthMS': row[1], 'popularity': row[2], 'artistID': row[3]}
+
+    def put_search(self, query, result):
+        '''
+        Store a search result
+        :param query: cleaned spotify search query
+        :param result: dict with trackID, lengthMS, popularity and artistID, None for an unmapped track
+        '''
+        result = result or {}
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?, ?, ?)',
+                              (query, result.get('trackID'), result.get('lengthMS'), result.get('popularity'),
+                               result.get('artistID'), time.time()))
+
+    def get_artists(self, artist_ids):
+        '''
+        Look up cached artist genres
+        :param artist_ids: list of spotify artist IDs
+        :return dict of artistID -> genre (genre is None for artists without genres), misses are left out
+        '''
+        found = {}
+        now = time.time()
+        with self.lock:
+            for artist_id in artist_ids:
+                row = self.conn.execute('SELECT genre, fetched_at FROM artist WHERE artist_id = ?',
+                                        (artist_id,)).fetchone()
+                hit = row is not None and now - row[1] < self.artist_ttl
+                self._count('artist', hit)
+                if hit:
+                    found[artist_id] = row[0]
+        return found
+
+    def put_artists(self, genres):
+        '''
+        Store artist genres
+        :param genres: dict of artistID -> genre
+        '''
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO artist VALUES (?, ?, ?)',
+                                  [(artist_id, genre, now) for artist_id, genre in genres.items()])
+
+    def get_features(self, track_ids):
+        '''
+        Look up cached audio features
+        :param track_ids: list of spotify track IDs
+        :return dict of trackID -> feature dict (None for tracks without features), misses are left out
+        '''
+        found = {}
+        now = time.time()
+        with self.lock:
+            for track_id in track_ids:
+                row = self.conn.execute('SELECT features, fetched_at FROM features WHERE track_id = ?',
+                                        (track_id,)).fetchone()
+                # features never change, only negative entries expire
+                hit = row is not None and (row[0] is not None or now - row[1] < self.negative_ttl)
+                self._count('features', hit)
+                if hit:
+                    found[track_id] = json.loads(row[0]) if row[0] is not None else None
+        return found
+
+    def put_features(self, features):
+        '''
+        Store audio features
+        :param features: dict of trackID -> feature dict, None for tracks without features
+        '''
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?)',
+                                  [(track_id, json.dumps(feature) if feature is not None else None, now)
+                                   for track_id, feature in features.items()])
+
+    def close(self):
+        '''
+        Close the underlying database connection
+        '''
+        with self.lock:
+            self.conn.close()
+
+
+class LRUCache:
+    '''
+    Bounded, thread-safe in-memory cache that evicts the least recently used entries
+    '''
+
+    def __init__(self, maxsize=10000):
+        '''
+        :param maxsize: maximum number of entries kept
+        '''
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Get an entry and mark it as recently used
+        :param key: cache key
+        :param default: value returned when the key isn't cached
+        :return cached value
+        '''
+        with self.lock:
+            if key not in self.data:
+                self.stats['misses'] += 1
+                return default
+            self.stats['hits'] += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        '''
+        Add an entry, evicting the least recently used one if the cache is full
+        :param key: cache key
+        :param value: value to cache
+        '''
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
@@ -0,0 +1,136 @@
+import os
+import re
+import threading
+
+import pandas as pd
+import yaml
+
+CHUNK_RE = re.compile(r'^\w+_\d{6}\.pkl$')  # file names written by chunk_path()
+PROGRESS_FILES = ('progress.yaml', 'progress.yaml.tmp')
+active_paths = set()  # checkpoint directories held by a run in this process
+active_lock = threading.Lock()
+
+
+class Checkpoint:
+    '''
+    Persists the intermediate results of a generate_dataset() run so a failed run can be resumed.
+    Each stage is stored as numbered chunks of dataframes, progress and run parameters are kept in progress.yaml.
+    A directory can only be held by one run at a time, use the checkpoint as a context manager or call release().
+    '''
+
+    def __init__(self, path, params=None, resume=False):
+        '''
+        :param path: directory the checkpoint is stored in
+        :param params: parameters of the run, a checkpoint written with different parameters is discarded
+        :param resume: reuse chunks of an earlier run, otherwise any existing checkpoint is cleared
+        :raises RuntimeError: if another run in this process holds the same directory
+        '''
+        self.path = path
+        self.params = params or {}
+        self.key = os.path.realpath(path)
+        with active_lock:
+            if self.key in active_paths:
+                raise RuntimeError("Checkpoint " + path + " is in use by another run")
+            active_paths.add(self.key)
+        try:
+            progress = self.load_progress()
+            if not resume or progress.get('params') != self.params:
+                if resume and progress:
+                    print("\nCheckpoint was written with different parameters, starting over")
+                self.clear()
+                progress = {}
+            elif progress:
+                print("\nResuming from checkpoint in " + path)
+            self.progress = progress
+            self.progress['params'] = self.params
+            os.makedirs(path, exist_ok=True)
+            self.save_progress()
+        except Exception:
+            self.release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        '''
+        Let other runs use the checkpoint directory, the files on disk are kept
+        '''
+        with active_lock:
+            active_paths.discard(self.key)
+
+    def load_progress(self):
+        '''
+        :return dict with the progress of each stage, empty if nothing was checkpointed
+        '''
+        progress_path = os.path.join(self.path, 'progress.yaml')
+        if not os.path.exists(progress_path):
+            return {}
+        with open(progress_path, 'r') as stream:
+            return yaml.safe_load(stream) or {}
+
+    def save_progress(self):
+        '''
+        Write progress.yaml, the file is replaced atomically so an interrupted write can't corrupt it
+        '''
+        progress_path = os.path.join(self.path, 'progress.yaml')
+        with open(progress_path + '.tmp', 'w') as stream:
+            yaml.safe_dump(self.progress, stream)
+        os.replace(progress_path + '.tmp', progress_path)
+
+    def chunk_path(self, stage, index):
+        return os.path.join(self.path, '{}_{:06d}.pkl'.format(stage, index))
+
+    def has_chunk(self, stage, index):
+        '''
+        :param stage: name of the pipeline stage
+        :param index: chunk number
+        :return True if the chunk was completed by this or an earlier run
+        '''
+        return index in self.progress.get(stage, [])
+
+    def load_chunk(self, stage, index):
+        '''
+        :param stage: name of the pipeline stage
+        :param index: chunk number
+        :return checkpointed dataframe
+        '''
+        return pd.read_pickle(self.chunk_path(stage, index))
+
+    def save_chunk(self, stage, index, df, **progress):
+        '''
+        Store a completed chunk of a stage
+        :param stage: name of the pipeline stage
+        :param index: chunk number
+        :param df: dataframe to store
+        :param progress: extra progress values recorded with the chunk
+        '''
+        df.to_pickle(self.chunk_path(stage, index))
+        self.progress.setdefault(stage, []).append(index)
+        self.progress.update(progress)
+        self.save_progress()
+
+    def load_stage(self, stage):
+        '''
+        :param stage: name of the pipeline stage
+        :return list of all completed chunks of a stage, in chunk order
+        '''
+        return [self.load_chunk(stage, index) for index in sorted(self.progress.get(stage, []))]
+
+    def clear(self):
+        '''
+        Remove the checkpoint from disk, only progress and chunk files are deleted so anything else stored in
+        the directory is left alone
+        '''
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            if name in PROGRESS_FILES or CHUNK_RE.match(name):
+                os.remove(os.path.join(self.path, name))
+        try:
+            os.rmdir(self.path)
+        except OSError:  # not empty
+            pass
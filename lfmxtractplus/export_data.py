@@ -1,62 +1,243 @@
 import requests, time
+import os
+import json
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import spotipy
 import re
 import yaml
 import logging
-from spotipy import oauth2
-from spotipy import SpotifyException
+from .cache import SpotifyCache, LRUCache
+from .checkpoint import Checkpoint
+from .matching import TrackIndex, FEAT_RE, SUFFIX_RE
+from .metrics import Metrics
+from .ratelimit import TokenBucket, RequestScheduler
 
+try:
+    from orjson import loads as json_loads  # optional, decodes large api responses several times faster
+except ImportError:
+    json_loads = json.loads
+
+loggers = {}  # log_path -> logger, instances writing to the same file share one logger and handler
+loggers_lock = threading.Lock()
+sync_state_lock = threading.Lock()  # serializes read-modify-write of sync_state.yaml
+
+LASTFM_API = 'https://ws.audioscrobbler.com/2.0/'
+LASTFM_QUERY = '?method=user.get{}&user={}&api_key={}&limit={}&page={}&format=json'
+SPOTIFY_API = 'https://api.spotify.com/v1/'
+LASTFM_RETRY_CODES = (8, 11, 16, 29)  # operation failed, service offline, temporarily unavailable, rate limited
+# rate limiters are shared by the instances using the same credentials, instances with their own keys don't
+# split one budget and a 429 for one spotify app doesn't pause the others
+lastfm_limiters = {}  # lf_key -> TokenBucket
+spotify_schedulers = {}  # sp_cid -> RequestScheduler
+limiters_lock = threading.Lock()
+
+AUDIO_FEATURES = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+                  'liveness', 'instrumentalness', 'valence', 'tempo']
+INTEGER_FEATURES = {'key': 'Int8', 'mode': 'Int8'}  # nullable, tracks without features are <NA>
+SCROBBLE_COLUMNS = ['timestamp', 'datetime', 'artist_name', 'artist_mbid', 'album_name', 'album_mbid', 'track_name',
+                    'track_mbid']
+PLAYLIST_FIELDS = 'total,items(track(id,name,duration_ms,popularity,artists(id,name)))'
+BRACKETS_RE = re.compile(r'\([^()\[\]]*\)|\[[^()\[\]]*\]')  # innermost (...) or [...]
+COMBINING_RE = re.compile(r'[\u0300-\u036f]')
+WHITESPACE_RE = re.compile(r'\s+')
+USERNAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]*$')  # last.fm usernames, also used as file names in data_path
+MISSING = object()  # default for cache lookups where None is a valid cached value
+CATEGORY_COLUMNS = ['artist_name', 'artist_mbid', 'album_name', 'album_mbid', 'track_name', 'track_mbid', 'trackID',
+                    'genre_name', 'track', 'artist', 'artistID', 'genre']
+
+
+class SpotifyAuthError(Exception):
+    '''
+    Raised when spotify authentication needs a browser login but the object runs headless
+    '''
+
+
+class LastfmError(Exception):
+    '''
+    Raised when a page of scrobbles can't be retrieved from last.fm
+    '''
+
+    def __init__(self, message, code=None):
+        '''
+        :param message: error message
+        :param code: last.fm api error code, None if the request itself failed
+        '''
+        super().__init__(message)
+        self.code = code
+
+
+def shared_limiter(registry, key, factory):
+    '''
+    Get the limiter registered for a credential, creating it on first use
+    :param registry: dict of credential -> limiter
+    :param key: api key or client id
+    :param factory: function creating a new limiter
+    :return limiter shared by every caller passing the same key
+    '''
+    with limiters_lock:
+        if key not in registry:
+            registry[key] = factory()
+        return registry[key]
+
+
+def chunked(seq, size):
+    '''
+    Splits a list into consecutive chunks
+    :param seq: list to split
+    :param size: maximum length of each chunk
+    :return generator of lists
+    '''
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def token_expired(token_info, margin=60):
+    '''
+    Checks whether an OAuth token expired or is about to, spotipy's own check was renamed between versions
+    :param token_info: token dict with expires_at
+    :param margin: seconds before expiry a token already counts as expired
+    :return True if the token needs to be refreshed, False if it is valid or has no known expiry
+    '''
+    expires_at = token_info.get('expires_at')
+    return expires_at is not None and expires_at - time.time() < margin
 
-cid = secret = lfkey = logPath = None  # vars for config.yaml
-logger = None  # global logger
 
 class lfmxtractplus:
 
     def __init__(self,cfgPath):
             self.load_cfg(cfgPath)
             self.init_logger()
-            self.authenticate()
+            self.lastfm_limiter = shared_limiter(lastfm_limiters, self.lfkey,
+                                                 lambda: TokenBucket(rate=5))  # last.fm allows ~5 requests per second
+            self.spotify_scheduler = shared_limiter(spotify_schedulers, self.cid,
+                                                    lambda: RequestScheduler(transient=(requests.RequestException,)))
+            self.session = self.init_session()
+            self.stores = {}  # 'cache' and 'match_index', opened by ensure_store() on first use
+            self.store_lock = threading.Lock()
+            self.artist_genres = LRUCache(maxsize=10000)  # in-memory artistID -> genre, shared across calls
+            self.metrics = Metrics()
+            self.token_lock = threading.Lock()
+            self.sp = self.sp_oauth = self.token_info = None  # set by authenticate() on the first spotify request
 
     def load_cfg(self, yaml_filepath):
         """
-        Load config vars from yaml
+        Load config vars from yaml, every object keeps its own config so objects with different credentials can
+        run side by side
         :param yaml_filepath: path to config.yaml
         """
-        global cid, secret, lfkey, logPath
         with open(yaml_filepath, 'r') as stream:
             config = yaml.safe_load(stream)
-        cid = config['sp_cid']
-        secret = config['sp_secret']
-        lfkey = config['lf_key']
-        logPath = config['log_path']
+        self.cid = config['sp_cid']
+        self.secret = config['sp_secret']
+        self.lfkey = config['lf_key']
+        self.logPath = config['log_path']
+        self.dataPath = config.get('data_path', 'data')
+        self.cachePath = config.get('cache_path')
+        self.queryOptions = config.get('normalize_queries') or {}  # extra clean_series() normalization
+        self.matchIndexPath = config.get('match_index_path')
+        self.matchThreshold = config.get('match_threshold', 0.9)
+        self.lfUrl = config.get('lf_api_url') or LASTFM_API  # api base urls, only overridden for a local mock server
+        self.spUrl = config.get('sp_api_url') or SPOTIFY_API
+        self.spAuth = config.get('sp_auth') or 'oauth'
+        self.tokenCachePath = config.get('sp_token_cache')
+        self.headless = config.get('headless', False)
 
     def init_logger(self):
         '''
-        Initialize logger globally
+        Initialize the logger for log_path, objects logging to the same file share a logger and its file handler
+        '''
+        path = os.path.abspath(self.logPath)
+        with loggers_lock:
+            if path not in loggers:
+                logger = logging.getLogger('lfmxtractplus.log{}'.format(len(loggers)))
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False  # log to the file only, not the console
+                handler = logging.FileHandler(path, 'w', 'utf-8')
+                formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+                handler.setFormatter(formatter)
+                logger.addHandler(handler)
+                loggers[path] = logger
+            self.logger = loggers[path]
+
+
+    def init_cache(self):
+        '''
+        Open the persistent spotify lookup cache if cache_path is set in config.yaml
+        :return SpotifyCache object, None if caching is disabled
+        '''
+        if not self.cachePath:
+            return None
+        return SpotifyCache(self.cachePath)
+
+    def init_match_index(self):
+        '''
+        Open the local track matching index, persisted if match_index_path is set in config.yaml
+        :return TrackIndex object
+        '''
+        return TrackIndex(self.matchIndexPath, threshold=self.matchThreshold)
+
+    def ensure_store(self, name, init):
+        '''
+        Open a store unless already done, objects only reading from last.fm never open the sqlite files
+        :param name: key in self.stores
+        :param init: function opening the store
+        :return the store
+        '''
+        if name not in self.stores:
+            with self.store_lock:
+                if name not in self.stores:
+                    self.stores[name] = init()
+        return self.stores[name]
 
+    @property
+    def cache(self):
         '''
-        global logPath, logger
-        logger = logging.getLogger()
-        logger.setLevel(logging.DEBUG)
-        handler = logging.FileHandler(logPath, 'w', 'utf-8')
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        SpotifyCache opened on first use, None if caching is disabled
+        '''
+        return self.ensure_store('cache', self.init_cache)
+
+    @cache.setter
+    def cache(self, cache):
+        self.stores['cache'] = cache
 
+    @property
+    def match_index(self):
+        '''
+        TrackIndex opened on first use, loading a persisted index reads the whole table
+        '''
+        return self.ensure_store('match_index', self.init_match_index)
+
+    @match_index.setter
+    def match_index(self, match_index):
+        self.stores['match_index'] = match_index
 
     def get_spotify_token(self):
         '''
         Get OAuth token from spotify.
+        User tokens are read from sp_token_cache if possible, otherwise the user is asked to login in a browser.
+        With sp_auth: 'client_credentials' an app token is requested instead, which needs no login.
         :return token_info dict
-        :return sp_oauth object
+        :return sp_oauth object (a SpotifyClientCredentials manager renewing app tokens itself for client_credentials)
         '''
-        sp_oauth = oauth2.SpotifyOAuth(client_id=cid, client_secret=secret,
-                                       redirect_uri='https://example.com/callback/')
+        from spotipy import oauth2
+        if self.spAuth == 'client_credentials':
+            from spotipy.cache_handler import MemoryCacheHandler
+            sp_oauth = oauth2.SpotifyClientCredentials(client_id=self.cid, client_secret=self.secret,
+                                                       cache_handler=MemoryCacheHandler())  # no .cache file in cwd
+            return {'access_token': sp_oauth.get_access_token(as_dict=False)}, sp_oauth  # fails early on bad credentials
+
+        sp_oauth = oauth2.SpotifyOAuth(client_id=self.cid, client_secret=self.secret,
+                                       redirect_uri='https://example.com/callback/', cache_path=self.tokenCachePath)
         token_info = sp_oauth.get_cached_token()
         if not token_info:
+            if self.headless:
+                raise SpotifyAuthError("No cached spotify token in " + str(self.tokenCachePath) +
+                                       ", authenticate once without headless to create it")
             auth_url = sp_oauth.get_authorize_url()
             print(auth_url)
             response = input('Paste the above link into your browser, then paste the redirect url here: ')
@@ -64,63 +245,295 @@ class lfmxtractplus:
             code = sp_oauth.parse_response_code(response)
             token_info = sp_oauth.get_access_token(code)
 
-            return token_info, sp_oauth
+        return token_info, sp_oauth
 
 
-    def token_refresh(self,token_info, sp_oauth):
+    def token_refresh(self, stale_token=None):
         '''
-        Used to refresh OAuth token if token expired
-        :param token_info dict
-        :param sp_oauth object
+        Refresh the OAuth token if it expired or is about to expire, called before every spotify request.
+        Thread-safe, concurrent callers refresh the token only once.
+        :param stale_token: access token rejected by spotify, forces a refresh unless another thread already did it
+        :return True if the token was refreshed
         '''
-        global sp
-        if sp_oauth._is_token_expired(token_info):
-            token_info_ref = sp_oauth.refresh_access_token(token_info['refresh_token'])
-            token_ref = token_info_ref['access_token']
-            sp = spotipy.Spotify(auth=token_ref)
-            logger.info("________token refreshed________")
+        if self.spAuth == 'client_credentials':
+            return False  # the credentials manager renews app tokens before every request
+        if stale_token is None and not token_expired(self.token_info):
+            return False  # fast path, no locking while the token is valid
+        with self.token_lock:
+            if self.token_info['access_token'] != stale_token and not token_expired(self.token_info):
+                return stale_token is not None  # refreshed by another thread meanwhile
+            token_info = self.sp_oauth.refresh_access_token(self.token_info['refresh_token'])
+            self.token_info = dict(self.token_info, **token_info)
+            self.sp = self.create_spotify(self.token_info['access_token'])
+            self.logger.info("________token refreshed________")
+            return True
 
 
     def authenticate(self):
         '''
-        authenticate with spotify
+        authenticate with spotify, called automatically by the first spotify request
+        '''
+        self.token_info, self.sp_oauth = self.get_spotify_token()  # authenticate with spotify
+        if self.spAuth == 'client_credentials':
+            self.sp = self.create_spotify(auth_manager=self.sp_oauth)
+        else:
+            self.sp = self.create_spotify(self.token_info['access_token'])  # spotify client of this object
+
+    def ensure_authenticated(self):
+        '''
+        Authenticate with spotify unless already done, objects only reading from last.fm never authenticate
+        '''
+        if self.sp is None:
+            with self.token_lock:
+                if self.sp is None:
+                    self.authenticate()
+
+    def access_token(self):
+        '''
+        :return the current spotify access token
+        '''
+        if self.spAuth == 'client_credentials' and self.sp_oauth is not None:
+            return self.sp_oauth.get_access_token(as_dict=False)  # cached until it is about to expire
+        return self.token_info['access_token']
+
+    def create_spotify(self, access_token=None, auth_manager=None):
+        '''
+        Create a spotipy client for an access token or a credentials manager
+        :param access_token: OAuth access token
+        :param auth_manager: SpotifyClientCredentials object, used when no access token is given
+        :return spotipy.Spotify object
         '''
-        global token_info, sp, sp_oauth
-        token_info, sp_oauth = self.get_spotify_token()  # authenticate with spotify
-        sp = spotipy.Spotify(auth=token_info['access_token'])  # create spotify object globally
+        import spotipy
+        # a session without retries, so 429s and 5xx responses reach spotify_scheduler instead of being retried
+        # (and slept on) by every worker on its own inside spotipy
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=16, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        client = spotipy.Spotify(auth=access_token, client_credentials_manager=auth_manager, requests_session=session)
+        client.prefix = self.spUrl
+        return client
 
 
-    def clean_query(self,q):
+    def clean_query(self, q, strip_feat=False, strip_suffixes=False, fold_unicode=False):
         '''
         optimizes queries for spotify for better chance of mapping spotifyID
         :param q: query string
+        :param strip_feat: remove "feat. X" / "ft. X" / "featuring X" credits
+        :param strip_suffixes: remove " - Remastered 2011", " - Live", " - Radio Edit" style suffixes
+        :param fold_unicode: strip accents and lowercase the query
         :return: optimized query string
         '''
-        def collapse_brackets(text, brackets="()[]"):
-            count = [0] * (len(brackets) // 2)  # count open/close brackets
-            saved_chars = []
-            for character in text:
-                for i, b in enumerate(brackets):
-                    if character == b:  # found bracket
-                        kind, is_close = divmod(i, 2)
-                        count[kind] += (-1) ** is_close  # `+1`: open, `-1`: close
-                        if count[kind] < 0:  # unbalanced bracket
-                            count[kind] = 0  # keep it
-                        else:  # found bracket to remove
-                            break
-                else:  # character is not a [balanced] bracket
-                    if not any(count):  # outside brackets
-                        saved_chars.append(character)
-            return ''.join(saved_chars)
-
-        s = collapse_brackets(q)
-        s = re.sub("'", '', s)
-        return s
+        return self.clean_series(pd.Series([q]), strip_feat, strip_suffixes, fold_unicode).iloc[0]
+
+    def clean_series(self, series, strip_feat=False, strip_suffixes=False, fold_unicode=False):
+        '''
+        Vectorized clean_query() over a whole series, each distinct string is only cleaned once.
+        Balanced (nested) bracketed parts and apostrophes are removed and whitespace is collapsed,
+        a string made up only of brackets keeps its brackets but is otherwise normalized the same way.
+        :param series: series of artist or track names
+        :param strip_feat: remove "feat. X" / "ft. X" / "featuring X" credits
+        :param strip_suffixes: remove " - Remastered 2011", " - Live", " - Radio Edit" style suffixes
+        :param fold_unicode: strip accents and lowercase the strings
+        :return: series of optimized query strings
+        '''
+        def tidy(values):  # accents, case and whitespace, also applied to the bracket-only fallback
+            if fold_unicode:
+                values = values.str.normalize('NFKD').str.replace(COMBINING_RE, '', regex=True).str.lower()
+            return values.str.replace(WHITESPACE_RE, ' ', regex=True).str.strip()
+
+        uniques = pd.Series(series.dropna().unique()).astype(str)
+        if uniques.empty:  # map() would return float64, which can't be concatenated into queries
+            return series.astype(object)
+        cleaned = uniques.copy()
+        # remove innermost bracket pairs until none are left, so nested brackets collapse too
+        nested = cleaned.str.contains(BRACKETS_RE)
+        while nested.any():
+            cleaned[nested] = cleaned[nested].str.replace(BRACKETS_RE, '', regex=True)
+            nested = cleaned.str.contains(BRACKETS_RE)
+        cleaned = cleaned.str.replace("'", '', regex=False)
+        if strip_feat:
+            cleaned = cleaned.str.replace(FEAT_RE, '', regex=True)
+        if strip_suffixes:
+            cleaned = cleaned.str.replace(SUFFIX_RE, '', regex=True)
+        cleaned = tidy(cleaned)
+        empty = cleaned == ''
+        if empty.any():
+            fallback = tidy(uniques[empty].str.replace("'", '', regex=False))
+            cleaned[empty] = fallback.where(fallback != '', uniques[empty])
+
+        return series.map(dict(zip(uniques, cleaned)))
+
 
+    def init_session(self, pool_size=16):
+        '''
+        Create a pooled http session for last.fm requests
+        :param pool_size: maximum number of connections kept alive
+        :return requests.Session object
+        '''
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        return session
+
+    def get_lastfm_page(self, username, page, method='recenttracks', limit=200, retries=3, from_uts=None):
+        '''
+        Retrieves a single page from the last.fm api, retrying with exponential backoff on failure
+        :param username: last.fm username for retrieval
+        :param page: page number to retrieve
+        :param method: api method
+        :param limit: number of records per page
+        :param retries: number of retries before giving up on the page
+        :param from_uts: only retrieve scrobbles after this unix timestamp
+        :return parsed json response
+        '''
+        request_url = self.lfUrl + LASTFM_QUERY.format(method, username, self.lfkey, limit, page)
+        if from_uts is not None:
+            request_url += '&from=' + str(int(from_uts))
+        endpoint = 'lastfm.' + method
+        for attempt in range(retries + 1):
+            if attempt:
+                self.metrics.record_retry(endpoint)
+            self.lastfm_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(request_url, timeout=30)
+                data = json_loads(response.content)
+                if response.status_code < 500 and data.get('error') not in LASTFM_RETRY_CODES:
+                    self.metrics.record_call(endpoint, time.perf_counter() - start, data.get('error'))
+                    return data
+                self.metrics.record_call(endpoint, time.perf_counter() - start, data.get('error', response.status_code),
+                                         throttled=data.get('error') == 29 or response.status_code == 429)
+                self.logger.warning("last.fm error on page %s : %s", page, data.get('message', response.status_code))
+            except (requests.RequestException, ValueError) as e:
+                self.metrics.record_call(endpoint, time.perf_counter() - start, e)
+                self.logger.warning("last.fm request failed on page %s : %s", page, type(e).__name__)
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+        self.logger.critical("Giving up on page %s", page)
+        raise LastfmError("Failed to retrieve page " + str(page) + " after " + str(retries) + " retries")
+
+    def check_lastfm_error(self, data, page):
+        '''
+        Raises LastfmError for an error response to a page request
+        :param data: parsed json response for a page
+        :param page: page number, for the log
+        '''
+        if 'error' in data:
+            self.logger.critical("Error code on page %s : %s", page, data['error'])
+            self.logger.critical("Error message on page %s : %s", page, data.get('message'))
+            raise LastfmError(data.get('message', 'last.fm error ' + str(data['error'])), code=data['error'])
+
+    def parse_scrobbles(self, data, method='recenttracks'):
+        '''
+        Extracts the fields of a page of scrobbles column by column
+        :param data: parsed json response for a page
+        :param method: api method
+        :return dict of column name -> values for timestamp (int64 array), artist_name, artist_mbid, album_name,
+                album_mbid, track_name and track_mbid
+        '''
+        # only retain completed scrobbles (aka, with timestamp and not 'now playing')
+        tracks = [scrobble for scrobble in data[method]['track'] if 'date' in scrobble]
+        artists = [scrobble['artist'] for scrobble in tracks]
+        albums = [scrobble['album'] for scrobble in tracks]
+        return {'timestamp': np.array([scrobble['date']['uts'] for scrobble in tracks], dtype=np.int64),
+                'artist_name': [artist['#text'] for artist in artists],
+                'artist_mbid': [artist['mbid'] for artist in artists],
+                'album_name': [album['#text'] for album in albums],
+                'album_mbid': [album['mbid'] for album in albums],
+                'track_name': [scrobble['name'] for scrobble in tracks],
+                'track_mbid': [scrobble['mbid'] for scrobble in tracks]}
+
+    def scrobbles_to_frame(self, columns=None, timezone='Asia/Kolkata'):
+        '''
+        Builds a scrobbles dataframe from parsed scrobbles
+        :param columns: dict returned by parse_scrobbles(), None for an empty dataframe
+        :param timezone: timezone of the user (must correspond with the timezone in user's settings)
+        :return dataframe with lastfm scrobbles
+        '''
+        columns = columns or {name: np.array([], dtype=object) for name in SCROBBLE_COLUMNS if name != 'datetime'}
+        timestamps = np.asarray(columns['timestamp'], dtype=np.int64)
+        frame = {'timestamp': timestamps,
+                 'datetime': pd.to_datetime(timestamps, unit='s', utc=True).tz_convert(timezone)}
+        frame.update((name, columns[name]) for name in SCROBBLE_COLUMNS[2:])
+        return pd.DataFrame(frame)
 
     #thanks to Geoff Boeing : https://github.com/gboeing/data-visualization/blob/master/lastfm-listening-history/lastfm_downloader.ipynb
 
-    def get_scrobbles(self,username, method='recenttracks', timezone='Asia/Kolkata', limit=200, page=1, pages=0):
+    def iter_scrobbles(self, username, method='recenttracks', timezone='Asia/Kolkata', limit=200, page=1, pages=0,
+                       workers=4, retries=3, from_uts=None):
+        '''
+        Retrieves scrobbles from lastfm for a user one page at a time.
+        Pages are fetched concurrently a few pages ahead of the consumer and yielded in page order (newest first).
+        :param method: api method
+        :param username: last.fm username for retrieval
+        :param timezone: timezone of the user (must correspond with the timezone in user's settings)
+        :param limit: api lets you retrieve up to 200 records per call
+        :param page: page of results to start retrieving at
+        :param pages: how many pages of results to retrieve. if 0, get as many as api can return.
+        :param workers: number of pages fetched concurrently (requests are still rate limited)
+        :param retries: number of retries for each page before giving up
+        :param from_uts: only retrieve scrobbles after this unix timestamp (used for incremental syncs)
+
+        :return generator of dataframes with lastfm scrobbles, one per page
+        '''
+        with self.metrics.stage('get_scrobbles') as stage:
+            print("\nFetching data from last.fm for user " + username)
+            # make first request, just to get the total number of pages
+            response = self.get_lastfm_page(username, page, method, limit, retries, from_uts)
+            # error handling
+            if 'error' in response:
+                print("Error code : " + str(response['error']))
+                self.logger.critical("Error code : %s", response['error'])
+                print("Error message : " + response['message'])
+                self.logger.critical("Error message : %s", response['message'])
+                raise LastfmError(response['message'], code=response['error'])
+
+            total_pages = int(response[method]['@attr']['totalPages'])
+            total_scrobbles = int(response[method]['@attr']['total'])
+            last_page = total_pages
+            if pages > 0:
+                last_page = min([total_pages, page + pages - 1])
+
+            print('\n{} total tracks scrobbled by the user'.format(total_scrobbles))
+            print('\n{} total pages to retrieve'.format(last_page - page + 1))
+            if last_page < page:
+                return
+
+            def fetch(page_no):
+                data = self.get_lastfm_page(username, page_no, method, limit, retries, from_uts)
+                self.check_lastfm_error(data, page_no)
+                return self.scrobbles_to_frame(self.parse_scrobbles(data, method), timezone)
+
+            workers = max(1, workers)
+            page_numbers = iter(range(page + 1, last_page + 1))
+            pending = deque()
+            progress = tqdm(total=last_page - page + 1)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                try:
+                    # keep a bounded number of pages in flight so memory doesn't grow with a slow consumer
+                    for page_no in itertools.islice(page_numbers, 2 * workers):
+                        pending.append(executor.submit(fetch, page_no))
+                    progress.update(1)
+                    df = self.scrobbles_to_frame(self.parse_scrobbles(response, method), timezone)
+                    response = None
+                    stage['rows'] += len(df)
+                    yield df
+                    while pending:
+                        df = pending.popleft().result()
+                        page_no = next(page_numbers, None)
+                        if page_no is not None:
+                            pending.append(executor.submit(fetch, page_no))
+                        progress.update(1)
+                        stage['rows'] += len(df)
+                        yield df
+                finally:
+                    for future in pending:
+                        future.cancel()
+                    progress.close()
+
+    def get_scrobbles(self, username, method='recenttracks', timezone='Asia/Kolkata', limit=200, page=1, pages=0,
+                      workers=4, retries=3, from_uts=None):
         '''
         Retrieves scrobbles from lastfm for a user
         :param method: api method
@@ -129,225 +542,294 @@ class lfmxtractplus:
         :param limit: api lets you retrieve up to 200 records per call
         :param page: page of results to start retrieving at
         :param pages: how many pages of results to retrieve. if 0, get as many as api can return.
+        :param workers: number of pages fetched concurrently (requests are still rate limited)
+        :param retries: number of retries for each page before giving up
+        :param from_uts: only retrieve scrobbles after this unix timestamp (used for incremental syncs)
 
         :return dataframe with lastfm scrobbles
         '''
+        try:
+            frames = list(self.iter_scrobbles(username, method, timezone, limit, page, pages, workers, retries,
+                                              from_uts))
+        except LastfmError as e:
+            if e.code is None:  # a page failed after retries, not an api error for the request itself
+                raise
+            return None
+        if not frames:
+            return self.scrobbles_to_frame(None, timezone)
+        return pd.concat(frames, ignore_index=True)
+
+    def search_track(self, query):
+        '''
+        Search spotify for a track, consulting the persistent cache first
+        :param query: spotify search query
+        :return dict with trackID, lengthMS, popularity and artistID, None if the track couldn't be mapped
+        '''
+        if self.cache is not None:
+            cached = self.cache.get_search(query)
+            if cached is not None:
+                return cached if cached['trackID'] is not None else None
+
+        searchDict = self.spotify_call('search', q=query, type='track', limit=1, market='US')
+        if searchDict is None:
+            return None  # failed call, don't cache it as unmapped
+        result = None
+        if len(searchDict['tracks']['items']) != 0:
+            item = searchDict['tracks']['items'][0]
+            result = {'trackID': item['id'], 'lengthMS': item['duration_ms'], 'popularity': item['popularity'],
+                      'artistID': item['artists'][0]['id']}
+        if self.cache is not None:
+            self.cache.put_search(query, result)
+        return result
+
+    def spotify_call(self, method, *args, **kwargs):
+        '''
+        Calls a spotipy method through the shared scheduler (which backs off on 429s and retries transient errors).
+        The OAuth token is refreshed before it expires, and once more if spotify rejects it anyway.
+        :param method: name of the spotipy method to call
+        :return api response, None if the call failed
+        '''
+        from spotipy import SpotifyException
+        endpoint = 'spotify.' + method
+        attempts = [0]
+        used_token = [None]
 
-        # initialize url and lists to contain response fields
-        print("\nFetching data from last.fm for user " + username)
-        url = 'https://ws.audioscrobbler.com/2.0/?method=user.get{}&user={}&api_key={}&limit={}&page={}&format=json'
-        responses = []
-        artist_names = []
-        artist_mbids = []
-        album_names = []
-        album_mbids = []
-        track_names = []
-        track_mbids = []
-        timestamps = []
-        # read from loadCFG()
-        key = lfkey
-        # make first request, just to get the total number of pages
-        request_url = url.format(method, username, key, limit, page)
-        response = requests.get(request_url).json()
-        # error handling
-        if 'error' in response:
-            print("Error code : " + str(response['error']))
-            logging.critical("Error code : " + str(response['error']))
-            print("Error message : " + response['message'])
-            logging.critical("Error message : " + response['message'])
+        def timed(*args, **kwargs):
+            if attempts[0]:
+                self.metrics.record_retry(endpoint)
+            attempts[0] += 1
+            self.ensure_authenticated()
+            self.token_refresh()  # refresh proactively instead of waiting for a 401
+            used_token[0] = self.access_token()
+            with self.metrics.timed_call(endpoint):
+                return getattr(self.sp, method)(*args, **kwargs)
+
+        try:
+            return self.spotify_scheduler.call(timed, *args, **kwargs)  # api call
+        except SpotifyException as e:
+            if e.http_status == 401 and self.token_refresh(stale_token=used_token[0]):
+                try:
+                    return self.spotify_scheduler.call(timed, *args, **kwargs)  # retry once with the new token
+                except (SpotifyException, requests.RequestException) as e:
+                    self.logger.critical("%s on %s", type(e).__name__, endpoint)
+                    return None
+            self.logger.critical("SpotifyException")
+            return None
+        except requests.RequestException as e:  # network errors the scheduler gave up retrying
+            self.logger.critical("%s on %s", type(e).__name__, endpoint)
             return None
 
-        total_pages = int(response[method]['@attr']['totalPages'])
-        total_scrobbles = int(response[method]['@attr']['total'])
-        if pages > 0:
-            total_pages = min([total_pages, pages])
-
-        print('\n{} total tracks scrobbled by the user'.format(total_scrobbles))
-        print('\n{} total pages to retrieve'.format(total_pages))
-
-        # request each page of data one at a time
-        for page in tqdm(range(1, int(total_pages) + 1, 1)):
-            time.sleep(0.20)
-            request_url = url.format(method, username, key, limit, page)
-            responses.append(requests.get(request_url))
-
-        # parse the fields out of each scrobble in each page (aka response) of scrobbles
-        for response in responses:
-            scrobbles = response.json()
-            if method in scrobbles.keys():
-                for scrobble in scrobbles[method]['track']:
-                    # only retain completed scrobbles (aka, with timestamp and not 'now playing')
-                    if 'date' in scrobble.keys():
-                        artist_names.append(scrobble['artist']['#text'])
-                        artist_mbids.append(scrobble['artist']['mbid'])
-                        album_names.append(scrobble['album']['#text'])
-                        album_mbids.append(scrobble['album']['mbid'])
-                        track_names.append(scrobble['name'])
-                        track_mbids.append(scrobble['mbid'])
-                        timestamps.append(scrobble['date']['uts'])
+    def get_artist_genres(self, artist_ids, batch_size=50, fetch=True):
+        '''
+        Get the first genre of each artist, resolving artists missing from the in-memory and persistent caches
+        in bulk (up to 50 per api call)
+        :param artist_ids: list of spotify artist IDs (may contain duplicates)
+        :param batch_size: number of artistIDs sent per api call (max 50)
+        :param fetch: fetch artists missing from the caches, otherwise they are left out
+        :return dict of artistID -> genre name (may be inaccurate as only the first genre is used), None for
+                artists without genres
+        '''
+        genres = {}
+        missing = []
+        for artist_id in dict.fromkeys(artist_ids):
+            genre = self.artist_genres.get(artist_id, MISSING)  # one lookup, None is a cached "no genres"
+            if genre is MISSING:
+                missing.append(artist_id)
             else:
-                print("Error occured, rerun")
-                logging.warning("Error occurred")
-
-        # create and populate a dataframe to contain the data
-        df = pd.DataFrame()
-        df['timestamp'] = timestamps
-        df['datetime'] = pd.to_datetime(df['timestamp'].astype(int), unit='s')
-        df['datetime'] = df['datetime'].dt.tz_localize('UTC').dt.tz_convert(timezone)
-        df['artist_name'] = artist_names
-        df['artist_mbid'] = artist_mbids
-        df['album_name'] = album_names
-        df['album_mbid'] = album_mbids
-        df['track_name'] = track_names
-        df['track_mbid'] = track_mbids
+                genres[artist_id] = genre
 
-        return df
+        if self.cache is not None and missing:
+            cached = self.cache.get_artists(missing)
+            genres.update(cached)
+            missing = [artist_id for artist_id in missing if artist_id not in cached]
+
+        for batch in chunked(missing if fetch else [], min(batch_size, 50)):
+            result = self.spotify_call('artists', batch)
+            if result is None:
+                continue
+            fetched = {artist['id']: artist['genres'][0] if artist['genres'] else None
+                       for artist in result['artists'] if artist}
+            if self.cache is not None:
+                self.cache.put_artists(fetched)
+            genres.update(fetched)
+
+        for artist_id, genre in genres.items():
+            self.artist_genres.put(artist_id, genre)
+        return genres
 
-    def map_to_spotify(self,scrobblesDF):
+    def map_to_spotify(self, scrobblesDF, workers=8):
         """
         Maps track names to spotifyID and adds track length,popularity,genre to dataframe.
+        Tracks are looked up in the local matching index first, only tracks it can't match are searched for.
+        Searches run concurrently, results keep the position of their row even if a search fails.
         :param scrobblesDF : lastfm scrobbles dataframe
+        :param workers : number of concurrent searches
         :return scrobblesDF : dataframe with spotifyID ,track length,popularity,genre
         """
-        track_ids = []
-        length = []
-        pop = []
-        genre = []
-        print("\n\nFetching SpotifyID for tracks")
-        for index, row in tqdm(scrobblesDF.iterrows(), total=scrobblesDF.shape[0]):
-            #time.sleep(2.5)
-            try:
+        with self.metrics.stage('map_to_spotify', rows=len(scrobblesDF)):
+            print("\n\nFetching SpotifyID for tracks")
+            artists = self.clean_series(scrobblesDF['artist_name'].fillna(''), **self.queryOptions)
+            tracks = self.clean_series(scrobblesDF['track_name'].fillna(''), **self.queryOptions)
+            queries = ('artist:' + artists + ' track:' + tracks).tolist()
+            keys = self.track_keys(scrobblesDF)
+            matches = [self.match_index.match(*key) for key in keys]
 
-                artist = self.clean_query(row['artist_name'])
-                track = self.clean_query(row['track_name'])
-
-                searchDict = sp.search(q='artist:' + artist + ' track:' + track, type='track', limit=1,
-                                       market='US')  # api call
-
-                logging.debug("Mapping spotifyID for " + track)
-                # logging.debug("Mapping spotifyID for " + str(index) + " out of " + str(len(scrobblesDF.index)-1))
-
-                if len(searchDict['tracks']['items']) != 0:
-                    track_ids.append(searchDict['tracks']['items'][0]['id'])
-                    length.append(searchDict['tracks']['items'][0]['duration_ms'])
-                    pop.append(searchDict['tracks']['items'][0]['popularity'])
-                    artist_id = searchDict['tracks']['items'][0]['artists'][0]['id']
-                    artist = sp.artist(artist_id)  # get genre from artist
-                    try:
-                        genreA = artist['genres'][0]  # gets only the first genre from list of genres (may be inaccurate)
-                        genre.append(genreA)
-                    except IndexError:
-                        genre.append(np.nan)
-                else:
-                    track_ids.append(np.nan)
-                    length.append(np.nan)
-                    pop.append(np.nan)
-                    genre.append(np.nan)
-                    logging.warning("failed to map " + track)
-            except SpotifyException:
-                if sp_oauth._is_token_expired(token_info):
-                    self.token_refresh(token_info, sp_oauth)  # refresh OAuth token
-                else:
-                    logging.critical("SpotifyException")
-
-        scrobblesDF['trackID'] = pd.Series(track_ids)
-        scrobblesDF['lengthMS'] = pd.Series(length)
-        scrobblesDF['popularity'] = pd.Series(pop)
-        scrobblesDF['genre_name'] = pd.Series(genre)
-
-        unmapped_cnt = scrobblesDF['trackID'].isna().sum()
-        print("\ntracks without spotifyID : " + str(unmapped_cnt))
+            def resolve(query, match):
+                if match is not None:
+                    return match
+                self.logger.debug("Mapping spotifyID for %s", query)
+                result = self.search_track(query)
+                if result is None:
+                    self.logger.warning("failed to map %s", query)
+                return result or {}
 
-        return scrobblesDF
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                results = list(tqdm(executor.map(resolve, queries, matches), total=len(queries)))
+
+            # remember searched tracks so later runs can map them (and similarly named tracks) locally
+            self.match_index.add([key + (result,) for key, match, result in zip(keys, matches, results)
+                                  if match is None])
+
+            resultsDF = pd.DataFrame(results, columns=['trackID', 'lengthMS', 'popularity', 'artistID'],
+                                     index=scrobblesDF.index)
+            scrobblesDF['trackID'] = resultsDF['trackID']
+            scrobblesDF['lengthMS'] = resultsDF['lengthMS']
+            scrobblesDF['popularity'] = resultsDF['popularity']
+            genres = self.get_artist_genres(resultsDF['artistID'].dropna().tolist())  # get genre from artists
+            scrobblesDF['genre_name'] = resultsDF['artistID'].map(genres)
+
+            unmapped_cnt = scrobblesDF['trackID'].isna().sum()
+            print("\ntracks without spotifyID : " + str(unmapped_cnt))
+
+            return scrobblesDF
+
+    def track_keys(self, scrobblesDF):
+        '''
+        :param scrobblesDF: dataframe with artist_name, track_name and optionally track_mbid columns
+        :return list of (artist_name, track_name, track_mbid) tuples used to look up tracks in the matching index
+        '''
+        mbids = scrobblesDF['track_mbid'] if 'track_mbid' in scrobblesDF.columns else [None] * len(scrobblesDF)
+        return list(zip(scrobblesDF['artist_name'].fillna(''), scrobblesDF['track_name'].fillna(''), mbids))
 
-    # todo: [for v2]pass 50 IDs at once in chunks to sp.audio_features to speedup
-    def map_audio_features(self, scrobblesDF):
+    def map_audio_features(self, scrobblesDF, batch_size=100):
         '''
         Adds track features to dataframe with SpotifyID.
+        Unique trackIDs are fetched in batches (up to 100 per api call) and joined back onto the dataframe.
         :param scrobblesDF: dataframe with SpotifyID
+        :param batch_size: number of trackIDs sent per api call (max 100)
         :return enriched dataframe with audio features
         '''
-        danceabilitySeries = []
-        energySeries = []
-        keySeries = []
-        loudnessSeries = []
-        modeSeries = []
-        speechinessSeries = []
-        acousticnessSeries = []
-        instrumentalnessSeries = []
-        livenessSeries = []
-        valenceSeries = []
-        tempoSeries = []
-        print("\nFetching audio features for tracks")
-        for index, row in tqdm(scrobblesDF.iterrows(), total=scrobblesDF.shape[0]):
-            try:
-                logging.debug("Fetching features for " + str(index) + " out of " + str(len(scrobblesDF.index) - 1))
-                if row['trackID'] is not np.nan:
-                    search_id = [str(row['trackID'])]
-                    feature = sp.audio_features(search_id)  # api call
-                    try:
-                        danceabilitySeries.append(feature[0]["danceability"])
-                        energySeries.append(feature[0]["energy"])
-                        keySeries.append(feature[0]["key"])
-                        loudnessSeries.append(feature[0]["loudness"])
-                        modeSeries.append(feature[0]["mode"])
-                        speechinessSeries.append(feature[0]["speechiness"])
-                        acousticnessSeries.append(feature[0]["acousticness"])
-                        livenessSeries.append(feature[0]["liveness"])
-                        valenceSeries.append(feature[0]["valence"])
-                        tempoSeries.append(feature[0]["tempo"])
-                        instrumentalnessSeries.append(feature[0]["instrumentalness"])
-                    except (TypeError, AttributeError, IndexError):
-                        logging.warning("\nTrack feature fetch failed for  " + row['track_name'])
-                        danceabilitySeries.append(np.nan)
-                        energySeries.append(np.nan)
-                        keySeries.append(np.nan)
-                        loudnessSeries.append(np.nan)
-                        modeSeries.append(np.nan)
-                        speechinessSeries.append(np.nan)
-                        acousticnessSeries.append(np.nan)
-                        livenessSeries.append(np.nan)
-                        valenceSeries.append(np.nan)
-                        tempoSeries.append(np.nan)
-                        instrumentalnessSeries.append(np.nan)
-
-                else:
-                    logging.warning("\nTrack ID not available for " + row['track_name'])
-                    danceabilitySeries.append(np.nan)
-                    energySeries.append(np.nan)
-                    keySeries.append(np.nan)
-                    loudnessSeries.append(np.nan)
-                    modeSeries.append(np.nan)
-                    speechinessSeries.append(np.nan)
-                    acousticnessSeries.append(np.nan)
-                    livenessSeries.append(np.nan)
-                    valenceSeries.append(np.nan)
-                    tempoSeries.append(np.nan)
-                    instrumentalnessSeries.append(np.nan)
+        with self.metrics.stage('map_audio_features', rows=len(scrobblesDF)):
+            print("\nFetching audio features for tracks")
+            track_ids = scrobblesDF['trackID'].dropna().astype(str).unique().tolist()
+            features = []
+            if self.cache is not None:
+                cached = self.cache.get_features(track_ids)
+                features = [[search_id] + [feature[name] for name in AUDIO_FEATURES]
+                            for search_id, feature in cached.items() if feature is not None]
+                track_ids = [search_id for search_id in track_ids if search_id not in cached]
+            for batch in tqdm(list(chunked(track_ids, min(batch_size, 100)))):
+                result = self.spotify_call('audio_features', batch)
+                if result is None:
                     continue
-            except SpotifyException:
-                if sp_oauth._is_token_expired(token_info):
-                    self.token_refresh(token_info, sp_oauth)  # refresh OAuth token
-                else:
-                    logging.critical("SpotifyException")
-
-        scrobblesDF['danceability'] = danceabilitySeries
-        scrobblesDF['energy'] = energySeries
-        scrobblesDF['key'] = keySeries
-        scrobblesDF['loudness'] = loudnessSeries
-        scrobblesDF['mode'] = modeSeries
-        scrobblesDF['speechiness'] = speechinessSeries
-        scrobblesDF['acousticness'] = acousticnessSeries
-        scrobblesDF['liveness'] = livenessSeries
-        scrobblesDF['instrumentalness'] = instrumentalnessSeries
-        scrobblesDF['valence'] = valenceSeries
-        scrobblesDF['tempo'] = tempoSeries
-
-        unmapped_cnt = scrobblesDF['trackID'].isna().sum()
-        print("tracks without audio features : " + str(unmapped_cnt))
+                # the api returns None in place of tracks it has no features for
+                fetched = {}
+                for search_id, feature in zip(batch, result or []):
+                    if not feature:
+                        self.logger.warning("Track feature fetch failed for %s", search_id)
+                        fetched[search_id] = None
+                        continue
+                    fetched[search_id] = {name: feature.get(name) for name in AUDIO_FEATURES}
+                    features.append([search_id] + [feature.get(name, np.nan) for name in AUDIO_FEATURES])
+                if self.cache is not None:
+                    self.cache.put_features(fetched)
 
-        return scrobblesDF
+            featuresDF = pd.DataFrame(features, columns=['trackID'] + AUDIO_FEATURES).set_index('trackID')
+            featuresDF = featuresDF.astype(dict.fromkeys(AUDIO_FEATURES, 'float64'))  # object when nothing was fetched
+            scrobblesDF = scrobblesDF.drop(columns=AUDIO_FEATURES, errors='ignore')
+            scrobblesDF = scrobblesDF.join(featuresDF, on='trackID')
+
+            unmapped_cnt = scrobblesDF['danceability'].isna().sum()
+            print("tracks without audio features : " + str(unmapped_cnt))
+
+            return scrobblesDF
+
+
+    def get_playlist_items(self, user, playlist_id, workers=4, limit=100):
+        '''
+        retrieves every track of a playlist, paging through the playlist with only the needed fields requested
+        :param user: username of the playlist owner
+        :param playlist_id: playlist id (found at the end of a playlist url)
+        :param workers: number of pages fetched concurrently after the first one
+        :param limit: tracks per page (max 100)
+        :return: list of (track, trackID, artist, artistID, lengthMS, popularity) tuples in playlist order
+        :return: number of pages that couldn't be retrieved, the list is incomplete if this isn't 0
+        '''
+        def fetch(offset):
+            page = self.spotify_call('user_playlist_tracks', user, playlist_id, fields=PLAYLIST_FIELDS,
+                                     limit=limit, offset=offset)
+            if page is None:
+                self.logger.critical("Failed to fetch playlist %s at offset %s", playlist_id, offset)
+            return page
+
+        first = fetch(0)
+        if first is None:
+            return [], 1
+        pages = [first]
+        offsets = range(limit, first['total'], limit)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pages.extend(executor.map(fetch, offsets))
+
+        items = []
+        for page in pages:
+            for item in (page or {}).get('items', []):
+                track = item.get('track')
+                if not track or not track.get('id'):  # removed tracks and local files have no spotifyID
+                    continue
+                items.append((track['name'], track['id'], track['artists'][0]['name'], track['artists'][0]['id'],
+                              track['duration_ms'], track['popularity']))
+        return items, pages.count(None)
+
+    def get_playlists(self, playlist_ids, user='billboard.com', workers=4):
+        '''
+        retrives audio features of several playlists, artists and audio features are resolved once for all of them
+        :param playlist_ids: list of playlist ids (found at the end of a playlist url)
+        :param user: username of the playlist owner
+        :param workers: number of playlists fetched concurrently
+        :return: a dictionary of playlist id -> dataframe with audio features of the playlist, every requested id is
+                 included (empty and unavailable playlists have an empty dataframe). The number of pages that couldn't
+                 be retrieved is stored in the dataframe's attrs['failed_pages']
+        '''
+        with self.metrics.stage('get_playlist') as stage:
+            print("\n\nFetching playlists")
+            playlist_ids = list(dict.fromkeys(playlist_ids))
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                fetched = list(tqdm(executor.map(lambda playlist_id: self.get_playlist_items(user, playlist_id),
+                                                 playlist_ids), total=len(playlist_ids)))
+
+            playlistsDF = pd.DataFrame([(playlist_id,) + item for playlist_id, (items, _) in zip(playlist_ids, fetched)
+                                        for item in items],
+                                       columns=['playlistID', 'track', 'trackID', 'artist', 'artistID', 'lengthMS',
+                                                'popularity'])
+            stage['rows'] = len(playlistsDF)
+            playlistsDF['genre'] = playlistsDF['artistID'].map(self.get_artist_genres(playlistsDF['artistID'].tolist()))
+            playlistsDF = playlistsDF[['playlistID', 'track', 'trackID', 'artist', 'artistID', 'genre', 'lengthMS',
+                                       'popularity']]
+            playlistsDF = self.map_audio_features(playlistsDF)
 
+            incomplete = {playlist_id: failed for playlist_id, (_, failed) in zip(playlist_ids, fetched) if failed}
+            if incomplete:
+                print("\nIncomplete playlists (failed pages) : " + str(incomplete))
+                self.logger.critical("Incomplete playlists (failed pages) : %s", incomplete)
+
+            groups = dict(list(playlistsDF.groupby('playlistID', sort=False)))
+            playlists = {}
+            for playlist_id in playlist_ids:
+                playlistDF = groups.get(playlist_id, playlistsDF.iloc[:0])  # empty or unavailable playlist
+                playlistDF = playlistDF.drop(columns='playlistID').reset_index(drop=True)
+                playlistDF.attrs['failed_pages'] = incomplete.get(playlist_id, 0)
+                playlists[playlist_id] = playlistDF
+            return playlists
 
     def get_playlist(self, user='billboard.com', playlist_id='6UeSakyzhiEt4NB3UAd6NQ'):
         '''
@@ -356,81 +838,437 @@ class lfmxtractplus:
         :param playlist_id: playlist id (found at the end of a playlist url)
         :return: a dataframe with audio features of a playlist
         '''
+        return self.get_playlists([playlist_id], user=user)[playlist_id]
 
-        trackID = []
-        track = []
-        artist = []
-        artistID = []
-        genre = []
-        lengthMS = []
-        popularity = []
-        try:
-            playlist = sp.user_playlist(user=user, playlist_id=playlist_id)
-            count = playlist['tracks']['total']
-            print("\n\nFetching playlist")
-            for i in tqdm(range(count)):
-                # print('fetching   ' + str(i) + ' out of ' + str(count) + '   ' + playlist['tracks']['items'][i]['track']['id'])
-                trackID.append(playlist['tracks']['items'][i]['track']['id'])
-                track.append(playlist['tracks']['items'][i]['track']['name'])
-                lengthMS.append(playlist['tracks']['items'][i]['track']['duration_ms'])
-                popularity.append(playlist['tracks']['items'][i]['track']['popularity'])
-                artist.append(playlist['tracks']['items'][i]['track']['artists'][0]['name'])
-                artistID.append(playlist['tracks']['items'][i]['track']['artists'][0]['id'])
-
-                artistOb = sp.artist(artistID[i])
-                try:
-                    genreA = artistOb['genres'][0]
-                    genre.append(genreA)
-                except IndexError:
-                    genre.append(None)
-        except SpotifyException:
-            if sp_oauth._is_token_expired(token_info):
-                self.token_refresh(token_info, sp_oauth)  # refresh OAuth token
+
+    def generate_dataset(self, lfusername, timezone='Asia/Kolkata', pages=0, incremental=False, resume=False,
+                         chunk_size=1000):
+        '''
+        Gets user's listening history and enriches it with Spotify audio features.
+        Progress is checkpointed to data_path after every chunk, so a failed run can be resumed with resume=True.
+        :param lfusername: last.fm username
+        :param timezone: timezone of the user (must correspond with the timezone in user's settings)
+        :param pages: number of pages to retrieve, use pages = 0 to retrieve full listening history
+        :param incremental: only fetch scrobbles newer than the last sync and append them to the dataset stored in data_path
+        :param resume: pick up a previously failed run from its last completed chunk
+        :param chunk_size: number of unique tracks mapped between checkpoints
+        :return scrobblesDFdict: dictionary with two dataframes ('complete' with timestamps and 'library' with library contents)
+        '''
+        self.check_username(lfusername)
+        stored = self.load_dataset(lfusername) if incremental else None
+        from_uts = None
+        if stored is not None and len(stored['complete']) > 0:
+            # the stored dataset itself is the high-water mark, sync_state.yaml could lag behind it
+            from_uts = int(stored['complete']['timestamp'].astype(int).max())
+
+        with Checkpoint(self.checkpoint_path(lfusername),
+                        params={'timezone': timezone, 'pages': pages, 'from_uts': from_uts,
+                                'chunk_size': chunk_size}, resume=resume) as checkpoint:
+            scrobblesDF_lastfm = self.fetch_scrobbles(lfusername, timezone, pages, from_uts,
+                                                      checkpoint)  # get all pages form lastfm with pages = 0
+            if scrobblesDF_lastfm is None:
+                return stored
+
+            if stored is not None:
+                if from_uts is not None:
+                    # drop scrobbles at the high-water mark itself in case the api treats 'from' as inclusive
+                    scrobblesDF_lastfm = scrobblesDF_lastfm[scrobblesDF_lastfm['timestamp'].astype(int) > from_uts]
+                if scrobblesDF_lastfm.empty:
+                    print("\nNo new scrobbles since last sync")
+                    checkpoint.clear()
+                    return stored
+                scrobblesDFdict = self.append_scrobbles(stored, scrobblesDF_lastfm, checkpoint, chunk_size)
             else:
-                logging.critical("SpotifyException")
+                scrobblesDF_condensed = scrobblesDF_lastfm[['artist_name', 'track_name']]
+
+                scrobblesDF_uniques = scrobblesDF_condensed.groupby(['artist_name', 'track_name']).size().reset_index()
+                scrobblesDF_uniques.rename(columns={0: 'frequency'}, inplace=True)
+
+                scrobblesDF_wFeatures_uniques = self.enrich_tracks(scrobblesDF_uniques, checkpoint, chunk_size)
+
+                scrobblesDF_complete = pd.merge(scrobblesDF_lastfm, scrobblesDF_wFeatures_uniques, how='left',
+                                                on=['track_name', 'artist_name'])
+                scrobblesDFdict = dict()
+                scrobblesDFdict['complete'] = scrobblesDF_complete
+                scrobblesDFdict['library'] = scrobblesDF_wFeatures_uniques
+
+            if incremental:
+                self.save_dataset(lfusername, scrobblesDFdict)
+            checkpoint.clear()
+
+        return scrobblesDFdict
 
-        playlistDF = pd.DataFrame()
+    def generate_datasets(self, lfusernames, timezone='Asia/Kolkata', pages=0, workers=4):
+        '''
+        Gets the listening history of several users and enriches it with Spotify audio features.
+        Scrobbles are fetched for all users in parallel and the union of their (artist, track) pairs is mapped once.
+        :param lfusernames: list of last.fm usernames
+        :param timezone: timezone of the users, or a dict of username -> timezone
+        :param pages: number of pages to retrieve per user, use pages = 0 to retrieve full listening histories
+        :param workers: number of users whose scrobbles are fetched concurrently
+        :return dictionary of username -> scrobblesDFdict ('complete' and 'library' dataframes, None if the
+                user's scrobbles couldn't be retrieved)
+        '''
+        lfusernames = list(dict.fromkeys(lfusernames))
 
-        playlistDF['track'] = pd.Series(track)
-        playlistDF['trackID'] = pd.Series(trackID)
-        playlistDF['artist'] = pd.Series(artist)
-        playlistDF['artistID'] = pd.Series(artistID)
-        playlistDF['genre'] = pd.Series(genre)
-        playlistDF['lengthMS'] = pd.Series(lengthMS)
-        playlistDF['popularity'] = pd.Series(popularity)
+        def fetch(lfusername):
+            user_timezone = timezone.get(lfusername, 'Asia/Kolkata') if isinstance(timezone, dict) else timezone
+            try:
+                return self.get_scrobbles(username=lfusername, timezone=user_timezone, pages=pages)
+            except LastfmError as e:  # one user's failed page mustn't abort the other users
+                self.logger.critical("Skipping %s : %s", lfusername, e)
+                print("\nFailed to retrieve scrobbles of " + lfusername)
+                return None
 
-        playlistDF = self.map_audio_features(playlistDF)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            scrobbles = dict(zip(lfusernames, executor.map(fetch, lfusernames)))
 
-        return playlistDF
+        pairs = [df[['artist_name', 'track_name']] for df in scrobbles.values() if df is not None]
+        if not pairs:
+            return {lfusername: None for lfusername in lfusernames}
+        scrobblesDF_uniques = pd.concat(pairs, ignore_index=True).groupby(['artist_name', 'track_name']).size()
+        scrobblesDF_uniques = scrobblesDF_uniques.rename('frequency').reset_index()
+        print("\n{} unique tracks across {} users".format(len(scrobblesDF_uniques), len(pairs)))
+        scrobblesDF_wFeatures_uniques = self.enrich_tracks(scrobblesDF_uniques).drop(columns='frequency')
 
+        datasets = dict()
+        for lfusername, scrobblesDF_lastfm in scrobbles.items():
+            if scrobblesDF_lastfm is None:
+                datasets[lfusername] = None
+                continue
+            counts = scrobblesDF_lastfm.groupby(['artist_name', 'track_name']).size().rename('frequency').reset_index()
+            library = pd.merge(counts, scrobblesDF_wFeatures_uniques, how='left', on=['artist_name', 'track_name'])
+            complete = pd.merge(scrobblesDF_lastfm, library, how='left', on=['track_name', 'artist_name'])
+            datasets[lfusername] = {'complete': complete, 'library': library}
 
-    def generate_dataset(self, lfusername, timezone='Asia/Kolkata', pages=0):
+        return datasets
+
+    def fetch_scrobbles(self, lfusername, timezone='Asia/Kolkata', pages=0, from_uts=None, checkpoint=None,
+                        pages_per_chunk=25):
         '''
-        Gets user's listening history and enriches it with Spotify audio features
+        Retrieves scrobbles like get_scrobbles(), storing them in the checkpoint every few pages
+        and continuing after the last checkpointed page when resuming
         :param lfusername: last.fm username
         :param timezone: timezone of the user (must correspond with the timezone in user's settings)
         :param pages: number of pages to retrieve, use pages = 0 to retrieve full listening history
-        :return scrobblesDFdict: dictionary with two dataframes ('complete' with timestamps and 'library' with library contents)
+        :param from_uts: only retrieve scrobbles after this unix timestamp
+        :param checkpoint: Checkpoint object, None to disable checkpointing
+        :param pages_per_chunk: number of pages stored per checkpoint
+        :return dataframe with lastfm scrobbles, None if last.fm returned an error
+        '''
+        if checkpoint is None:
+            return self.get_scrobbles(username=lfusername, timezone=timezone, pages=pages, from_uts=from_uts)
+
+        frames = checkpoint.load_stage('scrobbles')
+        pages_done = checkpoint.progress.get('scrobbles_pages', 0)
+        if not checkpoint.progress.get('scrobbles_done') and not (pages > 0 and pages_done >= pages):
+            buffer = []
+
+            def flush():
+                chunk = pd.concat(buffer, ignore_index=True)
+                checkpoint.save_chunk('scrobbles', len(frames), chunk, scrobbles_pages=pages_done)
+                frames.append(chunk)
+                del buffer[:]
+
+            try:
+                for df in self.iter_scrobbles(lfusername, timezone=timezone, page=pages_done + 1,
+                                              pages=pages - pages_done if pages > 0 else 0, from_uts=from_uts):
+                    buffer.append(df)
+                    pages_done += 1
+                    if len(buffer) == pages_per_chunk:
+                        flush()
+            except LastfmError as e:
+                if buffer:
+                    flush()  # keep every page that did arrive
+                if e.code is None:
+                    raise
+                return None
+            if buffer:
+                flush()
+            checkpoint.progress['scrobbles_done'] = True
+            checkpoint.save_progress()
+
+        if not frames:
+            return self.scrobbles_to_frame(None, timezone)
+        scrobblesDF = pd.concat(frames, ignore_index=True)
+        # pages shift when new scrobbles arrive between a failed run and its resume
+        return scrobblesDF.drop_duplicates(subset=['timestamp', 'artist_name', 'track_name']).reset_index(drop=True)
+
+    def enrich_tracks(self, uniquesDF, checkpoint=None, chunk_size=1000):
+        '''
+        Maps unique tracks to spotifyIDs and audio features chunk by chunk, checkpointing each completed stage
+        :param uniquesDF: dataframe with unique artist_name, track_name pairs
+        :param checkpoint: Checkpoint object, None to disable checkpointing
+        :param chunk_size: number of tracks per chunk
+        :return dataframe with spotifyID, track length, popularity, genre and audio features
         '''
-        scrobblesDF_lastfm = self.get_scrobbles(username=lfusername, timezone=timezone,
-                                           pages=pages)  # get all pages form lastfm with pages = 0
+        if len(uniquesDF) == 0:
+            return self.map_audio_features(self.map_to_spotify(uniquesDF))
 
-        scrobblesDF_condensed = scrobblesDF_lastfm[['artist_name', 'track_name']]
+        frames = []
+        for index, start in enumerate(range(0, len(uniquesDF), chunk_size)):
+            if checkpoint is not None and checkpoint.has_chunk('features', index):
+                frames.append(checkpoint.load_chunk('features', index))
+                continue
+            if checkpoint is not None and checkpoint.has_chunk('mapped', index):
+                chunk = checkpoint.load_chunk('mapped', index)
+            else:
+                chunk = self.map_to_spotify(uniquesDF.iloc[start:start + chunk_size].reset_index(drop=True))
+                if checkpoint is not None:
+                    checkpoint.save_chunk('mapped', index, chunk)
+            chunk = self.map_audio_features(chunk)
+            if checkpoint is not None:
+                checkpoint.save_chunk('features', index, chunk)
+            frames.append(chunk)
+        return pd.concat(frames, ignore_index=True)
 
-        scrobblesDF_uniques = scrobblesDF_condensed.groupby(['artist_name', 'track_name']).size().reset_index()
-        scrobblesDF_uniques.rename(columns={0: 'frequency'}, inplace=True)
+    def append_scrobbles(self, scrobblesDFdict, scrobblesDF_lastfm, checkpoint=None, chunk_size=1000):
+        '''
+        Appends newly fetched scrobbles to an existing dataset, only (artist, track) pairs missing from the library are mapped
+        :param scrobblesDFdict: dictionary with 'complete' and 'library' dataframes
+        :param scrobblesDF_lastfm: dataframe with new lastfm scrobbles
+        :param checkpoint: Checkpoint object, None to disable checkpointing
+        :param chunk_size: number of unique tracks mapped between checkpoints
+        :return scrobblesDFdict: dictionary with updated 'complete' and 'library' dataframes
+        '''
+        # drop scrobbles the dataset already has, so a lagging high-water mark can't duplicate them
+        key_columns = ['timestamp', 'artist_name', 'track_name']
+        stored_keys = scrobblesDFdict['complete'][key_columns].astype({'timestamp': 'int64'}).drop_duplicates()
+        new_keys = scrobblesDF_lastfm[key_columns].astype({'timestamp': 'int64'})
+        seen = pd.merge(new_keys, stored_keys, how='left', on=key_columns, indicator=True)['_merge'] == 'both'
+        scrobblesDF_lastfm = scrobblesDF_lastfm[~seen.to_numpy()].reset_index(drop=True)
 
-        scrobblesDF_wTrackID_uniques = self.map_to_spotify(scrobblesDF_uniques)
-        scrobblesDF_wFeatures_uniques = self.map_audio_features(scrobblesDF_wTrackID_uniques)
+        library = scrobblesDFdict['library']
+        new_counts = scrobblesDF_lastfm.groupby(['artist_name', 'track_name']).size().rename('new_frequency').reset_index()
 
-        scrobblesDF_complete = pd.merge(scrobblesDF_lastfm, scrobblesDF_wFeatures_uniques, how='left',
-                                        on=['track_name', 'artist_name'])
-        scrobblesDFdict = dict()
-        scrobblesDFdict['complete'] = scrobblesDF_complete
-        scrobblesDFdict['library'] = scrobblesDF_wFeatures_uniques
+        # bump the frequency of tracks already in the library
+        library = pd.merge(library, new_counts, how='left', on=['artist_name', 'track_name'])
+        library['frequency'] = library['frequency'] + library.pop('new_frequency').fillna(0).astype(int)
 
-        return scrobblesDFdict
+        # enrich only pairs not seen before
+        new_uniques = pd.merge(new_counts, library[['artist_name', 'track_name']], how='left',
+                               on=['artist_name', 'track_name'], indicator=True)
+        new_uniques = new_uniques[new_uniques['_merge'] == 'left_only'].drop(columns='_merge')
+        new_uniques = new_uniques.rename(columns={'new_frequency': 'frequency'}).reset_index(drop=True)
+        print("\n{} new tracks to map".format(len(new_uniques)))
+        if len(new_uniques) > 0:
+            new_uniques = self.enrich_tracks(new_uniques, checkpoint, chunk_size)
+            library = pd.concat([library, new_uniques], ignore_index=True, sort=False)
 
+        # re-join all scrobbles (newest first) with the updated library
+        lastfm_columns = list(scrobblesDF_lastfm.columns)
+        stored = scrobblesDFdict['complete'][lastfm_columns]
+        stored = stored.astype({'timestamp': 'int64'})  # datasets stored by older versions have string timestamps
+        scrobblesDF_all = pd.concat([scrobblesDF_lastfm, stored], ignore_index=True)
+        scrobblesDF_complete = pd.merge(scrobblesDF_all, library, how='left', on=['track_name', 'artist_name'])
+
+        return {'complete': scrobblesDF_complete, 'library': library}
+
+    def check_username(self, lfusername):
+        '''
+        Usernames are used to build paths inside data_path, reject anything that could point outside of it
+        :param lfusername: last.fm username
+        :return the username
+        :raises ValueError: if the username isn't a valid last.fm username
+        '''
+        if not isinstance(lfusername, str) or not USERNAME_RE.match(lfusername):
+            raise ValueError("Invalid last.fm username: " + repr(lfusername))
+        return lfusername
+
+    def dataset_path(self, lfusername):
+        '''
+        Path of the stored dataset for a user
+        :param lfusername: last.fm username
+        :return filepath inside data_path
+        '''
+        return os.path.join(self.dataPath, self.check_username(lfusername) + '.pkl')
+
+    def checkpoint_path(self, lfusername):
+        '''
+        Directory the checkpoint of a generate_dataset() run for a user is stored in
+        :param lfusername: last.fm username
+        :return directory inside data_path
+        '''
+        return os.path.join(self.dataPath, 'checkpoints', self.check_username(lfusername))
+
+    def load_dataset(self, lfusername):
+        '''
+        Loads a dataset previously stored by an incremental generate_dataset() call
+        :param lfusername: last.fm username
+        :return scrobblesDFdict: dictionary with 'complete' and 'library' dataframes, None if nothing is stored
+        '''
+        path = self.dataset_path(lfusername)
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def save_dataset(self, lfusername, scrobblesDFdict):
+        '''
+        Stores a dataset in data_path and records the newest scrobble timestamp as the user's high-water mark
+        :param lfusername: last.fm username
+        :param scrobblesDFdict: dictionary with 'complete' and 'library' dataframes
+        '''
+        os.makedirs(self.dataPath, exist_ok=True)
+        path = self.dataset_path(lfusername)
+        pd.to_pickle(scrobblesDFdict, path + '.tmp')
+        os.replace(path + '.tmp', path)  # readers never see a partially written dataset
+        timestamps = scrobblesDFdict['complete']['timestamp']
+        if len(timestamps) > 0:
+            self.set_high_water_mark(lfusername, timestamps.astype(int).max())
+
+    def get_high_water_mark(self, lfusername):
+        '''
+        Get the timestamp of the newest synced scrobble for a user
+        :param lfusername: last.fm username
+        :return unix timestamp, None if the user was never synced
+        '''
+        path = os.path.join(self.dataPath, 'sync_state.yaml')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as stream:
+            state = yaml.safe_load(stream) or {}
+        return state.get(lfusername)
+
+    def set_high_water_mark(self, lfusername, uts):
+        '''
+        Record the timestamp of the newest synced scrobble for a user, the mark never moves backwards.
+        The file is shared by all users, so it is updated under a lock and replaced atomically.
+        :param lfusername: last.fm username
+        :param uts: unix timestamp
+        '''
+        path = os.path.join(self.dataPath, 'sync_state.yaml')
+        with sync_state_lock:
+            state = {}
+            if os.path.exists(path):
+                with open(path, 'r') as stream:
+                    state = yaml.safe_load(stream) or {}
+            state[lfusername] = max(int(uts), state.get(lfusername, int(uts)))
+            with open(path + '.tmp', 'w') as stream:
+                yaml.safe_dump(state, stream)
+            os.replace(path + '.tmp', path)
+
+
+    def compact_dtypes(self, scrobblesDF):
+        '''
+        Converts a dataset dataframe to compact dtypes: integer timestamps, categorical names/mbids/IDs,
+        float32 audio features and nullable integers for key, mode, length, popularity and frequency
+        :param scrobblesDF: dataframe returned by generate_dataset(), get_scrobbles() or get_playlist()
+        :return dataframe with compact dtypes
+        '''
+        df = scrobblesDF.copy()
+        if 'timestamp' in df.columns:
+            df['timestamp'] = df['timestamp'].astype('int64')
+        for column in CATEGORY_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        for column in AUDIO_FEATURES:
+            if column in df.columns:
+                df[column] = df[column].astype(INTEGER_FEATURES.get(column, 'float32'))
+        for column, dtype in (('lengthMS', 'Int32'), ('popularity', 'Int8'), ('frequency', 'int32')):
+            if column in df.columns:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def export_dataset(self, scrobblesDFdict, path, normalized=False, partition=True):
+        '''
+        Writes a dataset returned by generate_dataset() as Parquet with compact dtypes (requires pyarrow).
+        Scrobbles are partitioned by year and month, library contents are written to library.parquet.
+        :param scrobblesDFdict: dictionary with 'complete' and 'library' dataframes
+        :param path: output directory
+        :param normalized: write scrobbles as fact rows referencing the library by (artist_name, track_name) and
+                           trackID instead of the denormalized 'complete' dataframe
+        :param partition: partition scrobbles by year and month
+        '''
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("export_dataset requires pyarrow, install it with pip install lfmxtractplus[parquet]")
+
+        library = self.compact_dtypes(scrobblesDFdict['library'])
+        complete = scrobblesDFdict['complete']
+        if normalized:
+            scrobbles = complete[[column for column in SCROBBLE_COLUMNS + ['trackID'] if column in complete.columns]]
+        else:
+            scrobbles = complete
+        scrobbles = self.compact_dtypes(scrobbles)
+
+        os.makedirs(path, exist_ok=True)
+        name = 'scrobbles' if normalized else 'complete'
+        if partition:
+            scrobbles = scrobbles.assign(year=scrobbles['datetime'].dt.year.astype('int16'),
+                                         month=scrobbles['datetime'].dt.month.astype('int8'))
+            scrobbles.to_parquet(os.path.join(path, name), engine='pyarrow', partition_cols=['year', 'month'],
+                                 index=False)
+        else:
+            scrobbles.to_parquet(os.path.join(path, name + '.parquet'), engine='pyarrow', index=False)
+        library.to_parquet(os.path.join(path, 'library.parquet'), engine='pyarrow', index=False)
+
+    def get_stats(self):
+        '''
+        Statistics collected since the object was created: wall time, rows and rows per second of each stage,
+        api calls, errors, retries, 429s and latency histograms per endpoint, and cache hits/misses
+        :return dictionary with 'stages', 'endpoints' and 'cache' statistics
+        '''
+        return self.metrics.snapshot(self.cache_stats())
+
+    def write_stats(self, path, format='json'):
+        '''
+        Write the statistics returned by get_stats() to a file
+        :param path: output filepath
+        :param format: 'json' or 'prometheus' (text exposition format)
+        '''
+        self.metrics.write(path, format, self.cache_stats())
+
+    def cache_stats(self):
+        '''
+        :return hit/miss counters of the in-memory artist cache, the matching index and the persistent cache tables,
+                stores that weren't opened yet are left out
+        '''
+        stats = {'artist_memory': dict(self.artist_genres.stats)}
+        match_index, cache = self.stores.get('match_index'), self.stores.get('cache')
+        if match_index is not None:
+            stats['match_index'] = dict(match_index.stats)
+        if cache is not None:
+            stats.update({table: dict(counts) for table, counts in cache.stats.items()})
+        return stats
+
+    def import_catalog(self, catalog):
+        '''
+        Adds known spotify tracks to the local matching index, e.g. from a catalog dump, a dataset or get_playlist()
+        :param catalog: dataframe, or filepath of a csv or parquet file, with artist_name (or artist),
+                        track_name (or track) and trackID columns and optional track_mbid, artistID, lengthMS and
+                        popularity columns
+        :return number of tracks added
+        '''
+        if isinstance(catalog, str):
+            catalog = pd.read_parquet(catalog) if catalog.endswith('.parquet') else pd.read_csv(catalog, dtype=str)
+        catalog = catalog.rename(columns={'artist': 'artist_name', 'track': 'track_name'})
+        catalog = catalog[catalog['trackID'].notna()]
+        results = catalog.reindex(columns=['trackID', 'lengthMS', 'popularity', 'artistID']).astype(object)
+        results = results.where(results.notna(), None).to_dict('records')
+        added = self.match_index.add([key + (result,) for key, result in zip(self.track_keys(catalog), results)])
+        print("\nImported {} tracks into the matching index".format(added))
+        return added
+
+    def rematch_unmapped(self, scrobblesDF):
+        '''
+        Maps tracks without a spotifyID using only the local matching index, no search requests are made.
+        Genres are filled in from the caches, call map_audio_features() afterwards to add audio features.
+        :param scrobblesDF: dataframe returned by map_to_spotify() or generate_dataset()
+        :return scrobblesDF: dataframe with trackID, lengthMS, popularity and genre_name filled in for matched tracks
+        '''
+        scrobblesDF = scrobblesDF.copy()
+        unmapped = scrobblesDF[scrobblesDF['trackID'].isna()]
+        matches = [self.match_index.match(*key) for key in self.track_keys(unmapped)]
+        matchedDF = pd.DataFrame([match or {} for match in matches],
+                                 columns=['trackID', 'lengthMS', 'popularity', 'artistID'], index=unmapped.index)
+        matchedDF['genre_name'] = matchedDF['artistID'].map(
+            self.get_artist_genres(matchedDF['artistID'].dropna().tolist(), fetch=False))
+        for column in ('trackID', 'lengthMS', 'popularity', 'genre_name'):
+            if column in scrobblesDF.columns:
+                scrobblesDF[column] = scrobblesDF[column].combine_first(matchedDF[column])
+        print("\nmatched {} of {} unmapped tracks".format(matchedDF['trackID'].notna().sum(), len(unmapped)))
+        return scrobblesDF
 
     def unmapped_tracks(self, scrobblesDF):
         '''
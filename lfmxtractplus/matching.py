@@ -0,0 +1,176 @@
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from difflib import SequenceMatcher
+
+from .cache import DAY
+
+# also used by query cleaning in export_data, so search queries and index keys strip the same credits and suffixes
+FEAT_RE = re.compile(r'\s+(?:feat\.?|ft\.?|featuring)\s.*$', re.IGNORECASE)
+SUFFIX_RE = re.compile(r'\s+-\s+[^-]*\b(?:remaster(?:ed)?|live|edit|version|mono|stereo|demo|acoustic|mix)\b.*$',
+                       re.IGNORECASE)
+# bracketed version info, e.g. "(Remastered 2011)", "[feat. X]"
+VERSION_RE = re.compile(r'[(\[][^()\[\]]*\b(?:remaster(?:ed)?|live|edit|version|mono|stereo|demo|mix|feat\.?|ft\.?|'
+                        r'featuring|with)\b[^()\[\]]*[)\]]')
+NON_WORD_RE = re.compile(r'[\W_]+')
+DIGITS_RE = re.compile(r'\d+')
+SEPARATOR = '\x1f'  # joins normalized artist and title into an index key
+
+
+def normalize(text):
+    '''
+    Normalizes an artist name or track title for matching, accents and case are folded, version info and
+    featured artists are removed and punctuation is dropped
+    :param text: artist name or track title
+    :return normalized string
+    '''
+    text = ''.join(char for char in unicodedata.normalize('NFKD', str(text)) if not unicodedata.combining(char))
+    text = VERSION_RE.sub(' ', text.lower())
+    text = SUFFIX_RE.sub('', FEAT_RE.sub('', text))
+    return NON_WORD_RE.sub(' ', text).strip()
+
+
+def ngrams(text, n=3):
+    '''
+    :param text: normalized string
+    :param n: length of the n-grams
+    :return set of character n-grams of the padded string
+    '''
+    text = ' ' + text + ' '
+    return {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+
+
+class TrackIndex:
+    '''
+    Local index of known spotify tracks, used to map scrobbles without a search request.
+    Tracks are matched by MusicBrainz recording ID, by normalized artist and title, or approximately through
+    an n-gram index of titles. The index can be persisted to a sqlite file.
+    Entries older than the ttl are treated as misses so their popularity is fetched again.
+    '''
+
+    def __init__(self, path=None, threshold=0.9, candidates=20, max_postings=1000, ttl=7 * DAY):
+        '''
+        :param path: filepath of the sqlite database, None keeps the index in memory only
+        :param threshold: minimum similarity (0 - 1) of both artist and title for an approximate match,
+                          1 disables approximate matching
+        :param candidates: number of titles sharing the most n-grams that are compared for an approximate match
+        :param max_postings: n-grams shared by more titles than this are too common to find candidates with
+        :param ttl: seconds before an indexed track is searched for again, same as SpotifyCache's popularity_ttl,
+                    None keeps entries forever
+        '''
+        self.path = path
+        self.threshold = threshold
+        self.candidates = candidates
+        self.max_postings = max_postings
+        self.ttl = ttl
+        self.records = {}  # key -> track record
+        self.fetched_at = {}  # key -> unix time the record was searched for
+        self.by_mbid = {}  # mbid -> key
+        self.grams = {}  # title n-gram -> set of keys
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS tracks (key TEXT PRIMARY KEY, mbid TEXT, track_id TEXT, '
+                                  'length_ms INTEGER, popularity INTEGER, artist_id TEXT, fetched_at REAL)')
+                columns = [row[1] for row in self.conn.execute('PRAGMA table_info(tracks)')]
+                if 'fetched_at' not in columns:  # index written before entries expired, its rows count as stale
+                    self.conn.execute('ALTER TABLE tracks ADD COLUMN fetched_at REAL')
+            rows = self.conn.execute('SELECT key, mbid, track_id, length_ms, popularity, artist_id, fetched_at '
+                                     'FROM tracks')
+            for key, mbid, track_id, length_ms, popularity, artist_id, fetched_at in rows:
+                self._insert(key, mbid, {'trackID': track_id, 'lengthMS': length_ms, 'popularity': popularity,
+                                         'artistID': artist_id}, fetched_at or 0.0)
+
+    def _insert(self, key, mbid, record, fetched_at):
+        if key not in self.records:
+            for gram in ngrams(key.split(SEPARATOR)[1]):
+                self.grams.setdefault(gram, set()).add(key)
+        self.records[key] = record
+        self.fetched_at[key] = fetched_at
+        if mbid:
+            self.by_mbid[mbid] = key
+
+    def _fresh(self, key):
+        return self.ttl is None or time.time() - self.fetched_at[key] < self.ttl
+
+    def add(self, tracks):
+        '''
+        Add tracks to the index, tracks already in the index are replaced
+        :param tracks: list of (artist, title, mbid, result) tuples, result is a dict with trackID, lengthMS,
+                       popularity and artistID as returned by a search
+        :return number of tracks added
+        '''
+        rows = []
+        now = time.time()
+        with self.lock:
+            for artist, title, mbid, result in tracks:
+                if not result or not result.get('trackID'):
+                    continue
+                key = normalize(artist) + SEPARATOR + normalize(title)
+                record = {name: result.get(name) for name in ('trackID', 'lengthMS', 'popularity', 'artistID')}
+                self._insert(key, mbid or None, record, now)
+                rows.append((key, mbid or None, record['trackID'], record['lengthMS'], record['popularity'],
+                             record['artistID'], now))
+            if self.conn is not None and rows:
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO tracks (key, mbid, track_id, length_ms, popularity, '
+                                          'artist_id, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def match(self, artist, title, mbid=None):
+        '''
+        Look up a track, first by MusicBrainz ID, then by normalized artist and title, then approximately
+        :param artist: artist name
+        :param title: track title
+        :param mbid: MusicBrainz recording ID, if known
+        :return dict with trackID, lengthMS, popularity and artistID, None if nothing matched or the match is stale
+        '''
+        artist_key, title_key = normalize(artist), normalize(title)
+        with self.lock:
+            key = self.by_mbid.get(mbid) if mbid else None
+            if key is None:
+                key = artist_key + SEPARATOR + title_key
+                if key not in self.records:
+                    key = self._closest(artist_key, title_key)
+            if key is not None and not self._fresh(key):
+                key = None
+            self.stats['hits' if key is not None else 'misses'] += 1
+            return dict(self.records[key]) if key is not None else None
+
+    def _closest(self, artist_key, title_key):
+        if self.threshold >= 1 or not title_key:
+            return None
+        shared = Counter()
+        for gram in ngrams(title_key):
+            postings = self.grams.get(gram, ())
+            if len(postings) <= self.max_postings:
+                shared.update(postings)
+        digits = DIGITS_RE.findall(title_key)
+        best, best_score = None, self.threshold
+        for key, _ in shared.most_common(self.candidates):
+            candidate_artist, candidate_title = key.split(SEPARATOR)
+            if DIGITS_RE.findall(candidate_title) != digits:  # "Part 1" and "Part 2" are different tracks
+                continue
+            score = min(SequenceMatcher(None, artist_key, candidate_artist).ratio(),
+                        SequenceMatcher(None, title_key, candidate_title).ratio())
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+    def close(self):
+        '''
+        Close the underlying database connection
+        '''
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))  # seconds
+
+
+class Metrics:
+    '''
+    Thread-safe collector for per-stage wall time and row counts and per-endpoint api call counts,
+    errors, retries, 429 responses and latency histograms
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {'calls': 0, 'errors': 0, 'throttled': 0, 'retries': 0,
+                                        'latency_sum': 0.0, 'latency_buckets': [0] * len(LATENCY_BUCKETS)}
+        return self.endpoints[endpoint]
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        '''
+        Context manager timing a pipeline stage, rows can be added to the yielded dict while the stage runs
+        :param name: name of the stage
+        :param rows: number of rows processed by the stage, if known upfront
+        '''
+        record = {'rows': rows}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0})
+                stage['calls'] += 1
+                stage['seconds'] += seconds
+                stage['rows'] += record['rows']
+
+    def record_call(self, endpoint, seconds, error=None, throttled=None):
+        '''
+        Record a single api request
+        :param endpoint: name of the api endpoint
+        :param seconds: latency of the request
+        :param error: exception raised by the request (or error returned by the api), if any
+        :param throttled: the request was rate limited, defaults to checking for a 429 status on error
+        '''
+        if throttled is None:
+            throttled = getattr(error, 'http_status', None) == 429
+        with self.lock:
+            stats = self._endpoint(endpoint)
+            stats['calls'] += 1
+            stats['latency_sum'] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['latency_buckets'][i] += 1
+                    break
+            if error is not None:
+                stats['errors'] += 1
+            if throttled:
+                stats['throttled'] += 1
+
+    def record_retry(self, endpoint):
+        '''
+        Record a retried api request
+        :param endpoint: name of the api endpoint
+        '''
+        with self.lock:
+            self._endpoint(endpoint)['retries'] += 1
+
+    @contextmanager
+    def timed_call(self, endpoint):
+        '''
+        Context manager recording the latency and outcome of an api request
+        :param endpoint: name of the api endpoint
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record_call(endpoint, time.perf_counter() - start, e)
+            raise
+        self.record_call(endpoint, time.perf_counter() - start)
+
+    def snapshot(self, cache_stats=None):
+        '''
+        :param cache_stats: hit/miss counters of the persistent cache to include
+        :return dict with 'stages', 'endpoints' and 'cache' statistics
+        '''
+        with self.lock:
+            stages = {name: dict(stage, rows_per_second=stage['rows'] / stage['seconds'] if stage['seconds'] else 0.0)
+                      for name, stage in self.stages.items()}
+            endpoints = {}
+            for name, stats in self.endpoints.items():
+                cumulative, buckets = 0, {}
+                for bound, count in zip(LATENCY_BUCKETS, stats['latency_buckets']):
+                    cumulative += count
+                    buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+                endpoints[name] = {'calls': stats['calls'], 'errors': stats['errors'],
+                                   'throttled': stats['throttled'], 'retries': stats['retries'],
+                                   'latency': {'sum': stats['latency_sum'], 'count': stats['calls'],
+                                               'buckets': buckets}}
+        return {'stages': stages, 'endpoints': endpoints, 'cache': cache_stats or {}}
+
+    def to_prometheus(self, cache_stats=None):
+        '''
+        :param cache_stats: hit/miss counters of the persistent cache to include
+        :return statistics in the Prometheus text exposition format
+        '''
+        stats = self.snapshot(cache_stats)
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE lfmxtractplus_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, val) for key, val in labels)
+                lines.append('lfmxtractplus_{}{{{}}} {}'.format(name, label_text, value))
+
+        stages = stats['stages'].items()
+        metric('stage_seconds_total', 'counter', [((('stage', name),), stage['seconds']) for name, stage in stages])
+        metric('stage_rows_total', 'counter', [((('stage', name),), stage['rows']) for name, stage in stages])
+        endpoints = stats['endpoints'].items()
+        for field in ('calls', 'errors', 'throttled', 'retries'):
+            metric('api_{}_total'.format(field), 'counter',
+                   [((('endpoint', name),), endpoint[field]) for name, endpoint in endpoints])
+        lines.append('# TYPE lfmxtractplus_api_latency_seconds histogram')
+        for name, endpoint in endpoints:
+            for bound, count in endpoint['latency']['buckets'].items():
+                lines.append('lfmxtractplus_api_latency_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                    name, bound, count))
+            lines.append('lfmxtractplus_api_latency_seconds_sum{{endpoint="{}"}} {}'.format(
+                name, endpoint['latency']['sum']))
+            lines.append('lfmxtractplus_api_latency_seconds_count{{endpoint="{}"}} {}'.format(
+                name, endpoint['latency']['count']))
+        for field in ('hits', 'misses'):
+            metric('cache_{}_total'.format(field), 'counter',
+                   [((('table', table),), counts[field]) for table, counts in stats['cache'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json', cache_stats=None):
+        '''
+        Write statistics to a file
+        :param path: output filepath
+        :param format: 'json' or 'prometheus'
+        :param cache_stats: hit/miss counters of the persistent cache to include
+        '''
+        with open(path, 'w') as stream:
+            if format == 'prometheus':
+                stream.write(self.to_prometheus(cache_stats))
+            else:
+                json.dump(self.snapshot(cache_stats), stream, indent=2)
@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket used to keep api calls under a service's rate limit
+    '''
+
+    def __init__(self, rate, capacity=None):
+        '''
+        :param rate: tokens added per second (sustained requests per second)
+        :param capacity: maximum number of tokens (burst size), defaults to rate
+        '''
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        '''
+        Blocks until the requested number of tokens is available
+        :param tokens: number of tokens to take
+        '''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RequestScheduler:
+    '''
+    Thread-safe scheduler shared by api calls that backs off globally when the service responds with
+    429 Too Many Requests (honouring the Retry-After header) and retries transient failures
+    '''
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0, limiter=None, transient=()):
+        '''
+        :param max_retries: number of retries for each call before the error is raised
+        :param backoff: base delay in seconds for exponential backoff
+        :param max_backoff: upper bound for a single delay in seconds
+        :param limiter: optional TokenBucket every call has to acquire a token from
+        :param transient: exception types (besides 429 and 5xx responses) that are worth retrying
+        '''
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self.transient = tuple(transient)
+        self.pause_until = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        '''
+        Hold back every call made through the scheduler
+        :param seconds: how long to pause for
+        '''
+        with self.lock:
+            self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    def wait(self):
+        '''
+        Blocks while the scheduler is paused, then takes a token from the limiter
+        '''
+        while True:
+            with self.lock:
+                delay = self.pause_until - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def retry_after(self, error, attempt):
+        '''
+        Seconds to wait before retrying a failed call, None if the error isn't worth retrying
+        :param error: exception raised by the call
+        :param attempt: number of the failed attempt (starting at 0)
+        '''
+        status = getattr(error, 'http_status', None)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        if status == 429:
+            headers = getattr(error, 'headers', None) or {}
+            try:
+                return float(headers.get('Retry-After', delay))
+            except (TypeError, ValueError):
+                return delay
+        if (status is not None and status >= 500) or isinstance(error, self.transient):
+            return delay
+        return None
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Calls func once the scheduler allows it, retrying throttled and transient failures
+        :param func: function making the api call
+        :return return value of func
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_after(e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                throttled = getattr(e, 'http_status', None) == 429
+                with self.lock:
+                    self.retries += 1
+                    self.throttled += throttled
+                if throttled:
+                    self.pause(delay)  # back off every caller, not just this one
+                else:
+                    time.sleep(delay)
+
+
+class AsyncRateLimiter:
+    '''
+    Rate limiter for asyncio code that can be shared by every coroutine on an event loop.
+    Combines a request rate (with bursts of up to capacity requests) with a global pause used for 429 responses.
+    It holds no loop-bound primitives, so one limiter can be shared across event loops.
+    '''
+
+    def __init__(self, rate=None, capacity=None):
+        '''
+        :param rate: sustained requests per second, None for no limit (pauses still apply)
+        :param capacity: number of requests allowed in a burst, defaults to rate
+        '''
+        self.interval = 1.0 / rate if rate else 0.0
+        self.capacity = capacity or rate or 1
+        self.next_free = 0.0
+        self.pause_until = 0.0
+
+    def pause(self, seconds):
+        '''
+        Hold back every request made through the limiter
+        :param seconds: how long to pause for
+        '''
+        self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        '''
+        Waits until a request may be made
+        '''
+        now = time.monotonic()
+        # reserve the next free slot, the first `capacity` slots are available immediately
+        slot = max(self.next_free, now)
+        self.next_free = slot + self.interval
+        wait = slot - now - (self.capacity - 1) * self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+        while True:
+            delay = self.pause_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
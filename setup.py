@@ -23,10 +23,18 @@ setup(
     install_requires=[
         "PyYAML >= 5.1.1",
         "numpy >= 1.14.0",
-        "pandas >= 0.22.0",
+        "pandas >= 1.0.0",
         "requests >= 2.22.0",
-        "spotipy >= 2.4.4",
+        "spotipy >= 2.19.0",
         "tqdm >= 4.31.1",
 
     ],
+    entry_points={
+        "console_scripts": ["lfmxtractplus=lfmxtractplus.__main__:main"],
+    },
+    extras_require={
+        "parquet": ["pyarrow >= 0.15.0"],
+        "async": ["aiohttp >= 3.6.0"],
+        "fast": ["orjson >= 3.0.0"],
+    },
 )